@@ -0,0 +1,102 @@
+'''Before/after benchmark for the AIA (CDF) file loader.
+
+This compares the original per-scan ``itertools.groupby`` loader with the
+array-based ``AIAFile`` loader on the sample data files, and checks that both
+produce identical intensity matrices.
+
+Usage::
+
+    $ python benchmarks/load_bench.py [--repeat N] [file.CDF ...]
+'''
+import os
+import sys
+import time
+import argparse
+import itertools as it
+
+import numpy as np
+import netCDF4 as cdf
+
+_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, _ROOT)
+
+from gcmstools.filetypes import AIAFile
+
+
+def legacy_load(fname):
+    '''The original scan-by-scan loader. Returns the intensity matrix.'''
+    data = cdf.Dataset(fname)
+
+    points = data.variables['point_count'][:]
+    mass_cdf = data.variables['mass_values'][:]
+    mass_min = int( np.round( mass_cdf.min() ) )
+    mass_max = int( np.round( mass_cdf.max() ) )
+    masses = np.arange(mass_min, mass_max +1)
+    inten_cdf = data.variables['intensity_values'][:]
+
+    intens = []
+    start = 0
+    for point in points:
+        int_zero = np.zeros(masses.size, dtype=float)
+        if point == 0: 
+            intens.append( int_zero )
+            continue
+            
+        mass_tmp = np.round( mass_cdf[start:start+point] ).astype(int)
+        ints_tmp = inten_cdf[start:start+point]
+        
+        mass_tmp2 = []
+        ints_tmp2 = []
+        for mass, mass_int in it.groupby( zip(mass_tmp, ints_tmp),
+                key=lambda x: x[0]):
+            ints = [i[1] for i in mass_int]
+            if len(ints) > 1:
+                ints = np.array( ints ).mean()
+            else:
+                ints = ints[0]
+            mass_tmp2.append(mass)
+            ints_tmp2.append(ints)
+        int_zero[np.array(mass_tmp2) - mass_min] = np.array(ints_tmp2)
+        intens.append( int_zero )
+        start += point
+
+    data.close()
+    return np.array(intens)
+
+
+def best_time(func, fname, repeat):
+    times = []
+    for i in range(repeat):
+        t0 = time.time()
+        result = func(fname)
+        times.append( time.time() - t0 )
+    return min(times), result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('files', nargs='*', 
+            help='CDF files to load. Defaults to the sample data files.')
+    parser.add_argument('--repeat', default=3, type=int,
+            help='Number of timing repeats. The best time is reported.')
+    args = parser.parse_args()
+
+    files = args.files
+    if not files:
+        folder = os.path.join(_ROOT, 'sampledata')
+        files = sorted(os.path.join(folder, f) for f in os.listdir(folder) 
+                if f[-3:].lower() == 'cdf')
+
+    line = '{:<20s} {:>8d} {:>12.4f} {:>12.4f} {:>8.1f}x {:>6s}'
+    print('{:<20s} {:>8s} {:>12s} {:>12s} {:>9s} {:>6s}'.format('file', 
+        'scans', 'before (s)', 'after (s)', 'speedup', 'equal'))
+    for fname in files:
+        old, old_int = best_time(legacy_load, fname, args.repeat)
+        new, aia = best_time(AIAFile, fname, args.repeat)
+        equal = np.array_equal(old_int, aia.intensity)
+        print(line.format(os.path.basename(fname), aia.times.size, old, new,
+            old/new, str(equal)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,82 @@
+'''Benchmark for the NNLS fitting methods of ``Nnls.nnls``.
+
+This fits the sample data files with the per-scan ``scipy.optimize.nnls``
+method and with the batched and warm-started solvers, and checks that the
+coefficients agree.
+
+Usage::
+
+    $ python benchmarks/nnls_bench.py [--refs ref_specs.txt] [--rt_filter]
+'''
+import os
+import sys
+import time
+import argparse
+
+import numpy as np
+
+_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, _ROOT)
+
+from gcmstools.general import open_file
+
+
+def timed_fit(gcms, repeat, **kwargs):
+    times = []
+    for i in range(repeat):
+        t0 = time.time()
+        gcms.nnls(cache=False, **kwargs)
+        times.append( time.time() - t0 )
+    return min(times), gcms.fits.copy()
+
+
+def main():
+    folder = os.path.join(_ROOT, 'sampledata')
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('files', nargs='*', 
+            help='CDF files to fit. Defaults to the sample data files.')
+    parser.add_argument('--refs', default=os.path.join(folder, 
+            'ref_specs.txt'), help='The reference spectra file.')
+    parser.add_argument('--repeat', default=3, type=int,
+            help='Number of timing repeats. The best time is reported.')
+    parser.add_argument('--rt_filter', action='store_true',
+            help='Use the retention time filter. The references need RT \
+            metadata.')
+    parser.add_argument('--rtol', default=1e-9, type=float,
+            help='Tolerance for the max coefficient difference relative to \
+            the largest coefficient.')
+    args = parser.parse_args()
+
+    files = args.files
+    if not files:
+        files = sorted(os.path.join(folder, f) for f in os.listdir(folder) 
+                if f[-3:].lower() == 'cdf')
+
+    line = '{:<20s} {:>8s} {:>8d} {:>10.4f} {:>8.1f}x {:>10.2e} {:>6s}'
+    print('{:<20s} {:>8s} {:>8s} {:>10s} {:>9s} {:>10s} {:>6s}'.format(
+        'file', 'method', 'scans', 'time (s)', 'speedup', 'rel diff', 
+        'match'))
+    for fname in files:
+        gcms = open_file(fname, args.refs, 'nnls')
+        name = os.path.basename(fname)
+        old, old_fits = timed_fit(gcms, args.repeat, method='scipy', 
+                rt_filter=args.rt_filter)
+        print(line.format(name, 'scipy', gcms.times.size, old, 1., 0., 
+            'True'))
+        for method in ('batch', 'warm'):
+            new, new_fits = timed_fit(gcms, args.repeat, method=method,
+                    rt_filter=args.rt_filter)
+            diff = np.abs(new_fits - old_fits).max()/np.abs(old_fits).max()
+            print(line.format(name, method, gcms.times.size, new, old/new, 
+                diff, str(diff <= args.rtol)))
+
+        gcms.nnls(method='warm', stats=True, rt_filter=args.rt_filter, 
+                cache=False)
+        print('    warm starts: {warm_scans} warm / {cold_scans} cold scans, '
+            '{iterations} iterations, {iterations_saved} saved'.format(
+                **gcms.nnls_stats))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,229 @@
+'''Benchmark suite on synthetic GCMS data.
+
+This makes a synthetic CDF file and reference library (see
+``synthetic.py``), and times the main stages of the processing: loading the
+file, parsing the references, ``ref_build``, the NNLS fits with and without
+the retention time filter, and the integration of every compound. The fits
+and integrals are checked against the true coefficients of the synthetic
+data.
+
+Nothing is downloaded, and the same settings always make the same data, so
+the reports of two commits can be compared. The caches are kept in the
+folder of the synthetic files, not in the user cache. The report is saved as JSON with
+``--out``, and ``--compare`` prints the speedup relative to an older report.
+
+Usage::
+
+    $ python benchmarks/suite.py --out new.json [--compare old.json]
+    $ python benchmarks/suite.py --scans 20000 --refs 200 --storage sparse
+'''
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+import argparse
+import platform
+import subprocess
+
+import numpy as np
+
+_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, _ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from gcmstools.general import open_file
+from gcmstools.filetypes import AIAFile
+from gcmstools.library import RefLibrary
+import synthetic
+
+
+def best_time(func, repeat):
+    times = []
+    for i in range(repeat):
+        t0 = time.time()
+        result = func()
+        times.append( time.time() - t0 )
+    return min(times), result
+
+
+def rel_error(value, true):
+    '''The max absolute error relative to the largest true value.'''
+    return float( np.abs(value - true).max()/np.abs(true).max() )
+
+
+def run(args, folder):
+    '''Make the data in folder, and return the timings and checks.'''
+    mass_range = [int(i) for i in args.mass_range.split(':')]
+    ref_name = os.path.join(folder, 'synth_refs.txt')
+    cdf_name = os.path.join(folder, 'synth.CDF')
+
+    lib = synthetic.make_library(ref_name, args.refs, mass_range,
+            args.peaks, coelution=args.coelution, seed=args.seed)
+    truth = synthetic.make_cdf(cdf_name, lib, args.scans, args.compounds,
+            width=args.width, noise=args.noise, noise_peaks=args.noise_peaks,
+            seed=args.seed)
+    true_fits = truth['fits']
+
+    timings = {}
+    checks = {}
+
+    timings['load'], _ = best_time(lambda: AIAFile(cdf_name,
+        storage=args.storage), args.repeat)
+
+    # The references are built again below without the background, so that
+    # the fits match the true coefficients. The first scan is empty, which
+    # makes an invalid background spectrum.
+    with np.errstate(invalid='ignore'):
+        gcms = open_file(cdf_name, ref_name, 'nnls', storage=args.storage)
+    timings['ref_parse'], refs = best_time(lambda: RefLibrary.load(ref_name,
+        use_cache=False), args.repeat)
+    timings['ref_build'], _ = best_time(lambda: gcms.ref_build(bkg=False,
+        library=refs), args.repeat)
+    checks['references'] = rel_error(np.array(gcms.ref_array),
+            lib['spectra'])
+
+    fits = {}
+    for name, kwargs in [('nnls', {}),
+            ('nnls_rt_filter', {'rt_filter': True}),
+            ('nnls_prescreen', {'prescreen': True})]:
+        timings[name], _ = best_time(lambda: gcms.nnls(cache=False,
+            **kwargs), args.repeat)
+        checks[name] = rel_error(gcms.fits, true_fits)
+        fits[name] = gcms.fits
+
+    # Integrate every compound over its elution peak. The integral of a
+    # reference is its fit times the area of its spectrum.
+    gcms.fits = fits['nnls']
+    windows = [(rt - 4*args.width, rt + 4*args.width) for rt in lib['rts']]
+    areas = lib['spectra'].sum(axis=1)
+    true_ints = []
+    for start, stop in windows:
+        mask = (truth['times'] > start) & (truth['times'] < stop)
+        true_ints.append( true_fits[mask].sum(axis=0)*areas )
+    true_ints = np.array(true_ints)
+
+    def loop():
+        ints = []
+        for start, stop in windows:
+            gcms.integrate(start, stop)
+            ints.append( gcms.integral )
+        return np.array(ints)
+
+    timings['integrate'], ints = best_time(loop, args.repeat)
+    checks['integrate'] = rel_error(ints, true_ints)
+    timings['integrate_many'], ints = best_time(lambda:
+            gcms.integrate_many(windows), args.repeat)
+    checks['integrate_many'] = rel_error(ints, true_ints)
+
+    return timings, checks
+
+
+def git_commit():
+    try:
+        out = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                cwd=_ROOT, stderr=subprocess.STDOUT)
+        return out.decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def report_print(report, old=None):
+    print('Commit: {}   Settings: {}'.format(report['commit'],
+        ' '.join('{}={}'.format(k, v) for k, v in
+            sorted(report['settings'].items()))))
+
+    line = '{:<16s} {:>10.4f} {:>10s} {:>9s} {:>10.2e} {:>6s}'
+    print('{:<16s} {:>10s} {:>10s} {:>9s} {:>10s} {:>6s}'.format('stage',
+        'time (s)', 'old (s)', 'speedup', 'rel error', 'ok'))
+    for name in sorted( set(report['timings']) | set(report['checks']) ):
+        new = report['timings'].get(name, float('nan'))
+        old_time = speedup = '-'
+        if old is not None and name in old['timings'] and \
+                name in report['timings']:
+            old_time = '{:.4f}'.format(old['timings'][name])
+            speedup = '{:.2f}x'.format(old['timings'][name]/new)
+        error = report['checks'].get(name, float('nan'))
+        ok = str(error <= report['settings']['rtol']) \
+                if name in report['checks'] else '-'
+        print(line.format(name, new, old_time, speedup, error, ok))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--scans', default=5000, type=int,
+            help='The number of scans in the CDF file.')
+    parser.add_argument('--refs', default=30, type=int,
+            help='The number of reference spectra.')
+    parser.add_argument('--compounds', default=None, type=int,
+            help='The number of references in the sample. Default is all.')
+    parser.add_argument('--mass_range', default='30:300',
+            help='The min:max nominal masses.')
+    parser.add_argument('--peaks', default=15, type=int,
+            help='The number of peaks in every reference spectrum.')
+    parser.add_argument('--coelution', default=0.2, type=float,
+            help='The fraction of co-eluting references.')
+    parser.add_argument('--width', default=0.01, type=float,
+            help='The width (std. dev.) of the elution peaks in minutes.')
+    parser.add_argument('--noise', default=0., type=float,
+            help='The relative noise of the intensities. The checks need a \
+            larger rtol with noise.')
+    parser.add_argument('--noise_peaks', default=0, type=int,
+            help='The number of random noise peaks in every scan.')
+    parser.add_argument('--storage', default='dense',
+            choices=['dense', 'lazy', 'sparse'],
+            help='The storage type of the intensity data.')
+    parser.add_argument('--seed', default=0, type=int,
+            help='The random seed.')
+    parser.add_argument('--repeat', default=3, type=int,
+            help='Number of timing repeats. The best time is reported.')
+    parser.add_argument('--rtol', default=1e-4, type=float,
+            help='Tolerance for the max error relative to the largest true \
+            value.')
+    parser.add_argument('--out', default=None,
+            help='Save the report to this JSON file.')
+    parser.add_argument('--compare', default=None,
+            help='An older JSON report to compare against.')
+    parser.add_argument('--keep', default=None,
+            help='Make the synthetic files in this folder, and keep them.')
+    args = parser.parse_args()
+
+    folder = args.keep or tempfile.mkdtemp(prefix='gcms_bench')
+    if not os.path.isdir(folder):
+        os.makedirs(folder)
+    # open_file and RefLibrary.load use the reference and fit caches. Keep
+    # them in the folder, so the user cache is not read or written.
+    os.environ['GCMSTOOLS_CACHE'] = os.path.join(folder, 'cache')
+    try:
+        timings, checks = run(args, folder)
+    finally:
+        if not args.keep:
+            shutil.rmtree(folder)
+
+    settings = vars(args).copy()
+    for key in ('out', 'compare', 'keep'):
+        del settings[key]
+    report = {'commit': git_commit(), 'settings': settings,
+            'timings': timings, 'checks': checks,
+            'python': platform.python_version(), 'numpy': np.__version__}
+
+    old = None
+    if args.compare:
+        with open(args.compare) as f:
+            old = json.load(f)
+        if old['settings'] != settings:
+            print('Warning: The old report used different settings.')
+
+    report_print(report, old)
+
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+
+    if not all(err <= args.rtol for err in checks.values()):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,211 @@
+'''Synthetic GCMS data for the benchmarks.
+
+This writes AIA (CDF) files and text reference libraries with a known
+composition. The reference spectra are random, and every compound elutes as a
+Gaussian peak at the retention time in its 'RT' metadata. The true fit
+coefficient of every reference in every scan is returned, so the fits and
+integrals can be checked, as well as timed. The data is made from a seed, so
+the same arguments always give the same files.
+
+Usage::
+
+    $ python benchmarks/synthetic.py folder [--scans N] [--refs N] ...
+'''
+import os
+import argparse
+
+import numpy as np
+import netCDF4 as cdf
+
+
+def make_library(fname, nrefs=20, mass_range=(30, 300), peaks=15,
+        rt_range=(2., 20.), coelution=0.2, seed=0):
+    '''Write a random reference library in the text (MassBank) format.
+
+    Arguments
+    ---------
+    * fname: string - The name of the reference file.
+    * nrefs: int - The number of reference spectra.
+    * mass_range: tuple - The (min, max) nominal masses of the data. The
+      peaks are between these masses.
+    * peaks: int - The number of peaks in every spectrum.
+    * rt_range: tuple - The (min, max) retention times in minutes.
+    * coelution: float - The fraction of the references that elute within a
+      few seconds of another reference.
+    * seed: int - The random seed.
+
+    Returns
+    -------
+    A dictionary with the reference 'names', retention times 'rts', the
+    'masses', and the 'spectra' (refs x masses) normalized to a max of 1.
+    These are the spectra that ``ref_build`` makes from the file.
+    '''
+    rand = np.random.RandomState(seed)
+    masses = np.arange(mass_range[0], mass_range[1] + 1)
+    # ``ref_build`` only keeps the masses strictly inside the mass range of
+    # the data, so the end masses have no peaks
+    peaks = min(peaks, masses.size - 2)
+
+    rts = rand.uniform(rt_range[0], rt_range[1], nrefs)
+    ncoel = int( round(coelution*nrefs) )
+    if nrefs > 1:
+        for i in range(ncoel):
+            partner = rand.randint(nrefs - 1)
+            if partner >= i:
+                partner += 1
+            rts[i] = rts[partner] + rand.uniform(-0.03, 0.03)
+    rts = np.round(rts, 3)
+
+    names = ['synth{:05d}'.format(i) for i in range(nrefs)]
+    spectra = np.zeros((nrefs, masses.size))
+    with open(fname, 'w') as f:
+        for name, rt, spec in zip(names, rts, spectra):
+            cols = 1 + np.sort( rand.choice(masses.size - 2, peaks,
+                replace=False) )
+            rel = np.round( rand.uniform(1., 99.99, peaks), 2 )
+            rel[ rand.randint(peaks) ] = 99.99
+            spec[cols] = rel/99.99
+
+            f.write('NAME:{}\n'.format(name))
+            f.write('RT:{:.3f}\n'.format(rt))
+            f.write('NUM PEAKS:\n')
+            for col, val in zip(cols, rel):
+                f.write('  {:d} {:.2f} {:d}\n'.format(masses[col], val,
+                    int(round(val*10))))
+            f.write('\n')
+
+    return {'names': names, 'rts': rts, 'masses': masses,
+            'spectra': spectra}
+
+
+def make_cdf(fname, library, scans=3000, compounds=None, width=0.01,
+        noise=0., noise_peaks=0, chunk=2000, seed=0):
+    '''Write an AIA (CDF) file of a sample made from a reference library.
+
+    The scans are spread evenly over the retention times of the library,
+    plus one minute on either side. Every scan has points at the lowest and
+    highest mass of the library, so the file has the same mass range as the
+    reference spectra.
+
+    Arguments
+    ---------
+    * fname: string - The name of the CDF file.
+    * library: dict - A library from ``make_library``.
+    * scans: int - The number of scans.
+    * compounds: None (default) or int - The number of references that are
+      in the sample. None uses all of them.
+    * width: float - The standard deviation of the elution peaks in
+      minutes.
+    * noise: float - The relative standard deviation of the noise that is
+      added to every intensity. The true coefficients are then only
+      approximate.
+    * noise_peaks: int - The number of random low intensity peaks that are
+      added to every scan.
+    * chunk: int - The number of scans that are made at once.
+    * seed: int - The random seed.
+
+    Returns
+    -------
+    A dictionary with the scan 'times' in minutes and the true 'fits'
+    (scans x refs), in the order of the library.
+    '''
+    rand = np.random.RandomState(seed)
+    spectra = library['spectra']
+    masses = library['masses']
+    rts = library['rts']
+    nrefs = rts.size
+
+    amps = np.zeros(nrefs)
+    used = np.arange(nrefs)
+    if compounds is not None and compounds < nrefs:
+        used = rand.choice(nrefs, compounds, replace=False)
+    amps[used] = rand.uniform(1e3, 1e5, used.size)
+
+    times = np.linspace(rts.min() - 1., rts.max() + 1., scans)
+    fits = np.zeros((scans, nrefs))
+
+    data = cdf.Dataset(fname, 'w', format='NETCDF3_CLASSIC')
+    data.createDimension('scan_number', scans)
+    data.createDimension('point_number', None)
+    time_var = data.createVariable('scan_acquisition_time', 'f8',
+            ('scan_number',))
+    index_var = data.createVariable('scan_index', 'i4', ('scan_number',))
+    count_var = data.createVariable('point_count', 'i4', ('scan_number',))
+    tic_var = data.createVariable('total_intensity', 'f8', ('scan_number',))
+    mass_var = data.createVariable('mass_values', 'f4', ('point_number',))
+    inten_var = data.createVariable('intensity_values', 'f4',
+            ('point_number',))
+    time_var[:] = times*60.
+
+    start = 0
+    for first in range(0, scans, chunk):
+        last = min(first + chunk, scans)
+        # Gaussian elution peaks, cut off at 1e-3 of the height
+        peak = np.exp( -0.5*((times[first:last, np.newaxis] - rts)/width)**2 )
+        peak[peak < 1e-3] = 0.
+        fits[first:last] = peak*amps
+
+        inten = fits[first:last].dot(spectra)
+        if noise:
+            inten *= 1. + noise*rand.standard_normal(inten.shape)
+            inten = np.clip(inten, 0., None)
+        if noise_peaks:
+            rows = np.repeat(np.arange(last - first), noise_peaks)
+            cols = rand.randint(masses.size, size=rows.size)
+            inten[rows, cols] += rand.uniform(1., 10., rows.size)
+
+        # Keep the non-zero points and both ends of the mass range
+        keep = inten > 0.
+        keep[:, [0, -1]] = True
+        counts = keep.sum(axis=1)
+        rows, cols = np.nonzero(keep)
+        # The masses are not exact in real files
+        mass = masses[cols] + rand.uniform(-0.2, 0.2, cols.size)
+
+        stop = start + rows.size
+        count_var[first:last] = counts
+        index_var[first:last] = start + np.append(0, np.cumsum(counts)[:-1])
+        tic_var[first:last] = inten.sum(axis=1)
+        mass_var[start:stop] = mass
+        inten_var[start:stop] = inten[rows, cols]
+        start = stop
+
+    data.close()
+
+    return {'times': times, 'fits': fits}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('folder', help='The folder for the new files.')
+    parser.add_argument('--scans', default=3000, type=int,
+            help='The number of scans in the CDF file.')
+    parser.add_argument('--refs', default=20, type=int,
+            help='The number of reference spectra.')
+    parser.add_argument('--compounds', default=None, type=int,
+            help='The number of references in the sample. Default is all.')
+    parser.add_argument('--mass_range', default='30:300',
+            help='The min:max nominal masses.')
+    parser.add_argument('--peaks', default=15, type=int,
+            help='The number of peaks in every reference spectrum.')
+    parser.add_argument('--coelution', default=0.2, type=float,
+            help='The fraction of co-eluting references.')
+    parser.add_argument('--noise', default=0., type=float,
+            help='The relative noise of the intensities.')
+    parser.add_argument('--seed', default=0, type=int,
+            help='The random seed.')
+    args = parser.parse_args()
+
+    if not os.path.isdir(args.folder):
+        os.makedirs(args.folder)
+    mass_range = [int(i) for i in args.mass_range.split(':')]
+    lib = make_library(os.path.join(args.folder, 'synth_refs.txt'),
+            args.refs, mass_range, args.peaks, coelution=args.coelution,
+            seed=args.seed)
+    truth = make_cdf(os.path.join(args.folder, 'synth.CDF'), lib,
+            args.scans, args.compounds, noise=args.noise, seed=args.seed)
+    np.save(os.path.join(args.folder, 'synth_fits.npy'), truth['fits'])
+
+
+if __name__ == '__main__':
+    main()
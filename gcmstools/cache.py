@@ -0,0 +1,147 @@
+'''On-disk caches for processed GCMS data.
+
+Cache entries are NumPy ``.npz`` files named by a content hash of everything
+that went into them, so a stale entry is never reused. The cache folder is
+set by the ``GCMSTOOLS_CACHE`` environment variable, and defaults to
+``~/.gcmstools_cache``. The least recently used entries are removed once the
+cache is larger than ``GCMSTOOLS_CACHE_MB`` megabytes (default 2000).
+'''
+import os
+import json
+import hashlib
+
+import numpy as np
+
+# Content hashes of files that were already read in this process. The keys
+# are (path, size, mtime), so a modified file is hashed again.
+_HASHES = {}
+# The default size limit of the cache folder in megabytes
+MAX_MB = 2000
+
+def cache_dir():
+    '''Return the cache folder, and create it if necessary.'''
+    folder = os.environ.get('GCMSTOOLS_CACHE', 
+            os.path.join(os.path.expanduser('~'), '.gcmstools_cache'))
+    if not os.path.isdir(folder):
+        os.makedirs(folder)
+    return folder
+
+
+def max_bytes():
+    '''Return the size limit of the cache folder in bytes.'''
+    return int( float(os.environ.get('GCMSTOOLS_CACHE_MB', MAX_MB))*1024**2 )
+
+
+def file_hash(fname, blocksize=1 << 20):
+    '''Return the SHA1 hex digest of the contents of a file.
+
+    The digest is also saved in the cache folder under the path, size, and
+    modification time of the file, so the file is only read again by later
+    runs if it changed.
+    '''
+    stat = os.stat(fname)
+    stamp = (os.path.abspath(fname), stat.st_size, stat.st_mtime)
+    if stamp in _HASHES:
+        return _HASHES[stamp]
+
+    stamp_key = hashlib.md5( repr(stamp).encode('utf-8') ).hexdigest()
+    stamp_file = os.path.join(cache_dir(), 'hash_{}.sha1'.format(stamp_key))
+    digest = None
+    try:
+        with open(stamp_file) as f:
+            digest = f.read().strip()
+        os.utime(stamp_file, None)
+    except (IOError, OSError):
+        pass
+
+    if not digest or len(digest) != 40:
+        sha = hashlib.sha1()
+        with open(fname, 'rb') as f:
+            for block in iter(lambda: f.read(blocksize), b''):
+                sha.update(block)
+        digest = sha.hexdigest()
+        tmp = '{}.{}.tmp'.format(stamp_file, os.getpid())
+        with open(tmp, 'w') as f:
+            f.write(digest)
+        os.rename(tmp, stamp_file)
+
+    _HASHES[stamp] = digest
+    return digest
+
+
+def cache_key(*parts):
+    '''Return a hash key for a sequence of JSON serializable values.'''
+    text = json.dumps(parts, sort_keys=True)
+    return hashlib.sha1( text.encode('utf-8') ).hexdigest()
+
+
+def cache_path(prefix, key):
+    return os.path.join(cache_dir(), '{}_{}.npz'.format(prefix, key))
+
+
+def load_arrays(prefix, key):
+    '''Return a dictionary of the cached arrays, or None if not cached.'''
+    fname = cache_path(prefix, key)
+    if not os.path.exists(fname):
+        return None
+    try:
+        with np.load(fname) as data:
+            arrays = dict( (k, data[k]) for k in data.files )
+        # Mark the entry as recently used for the purge
+        os.utime(fname, None)
+        return arrays
+    except (IOError, OSError, ValueError):
+        # A damaged or partially written file is treated as a cache miss
+        return None
+
+
+def save_arrays(prefix, key, **arrays):
+    '''Save a set of arrays to the cache.'''
+    fname = cache_path(prefix, key)
+    # Write to a temporary file first, so that other processes never see a
+    # partial cache file
+    tmp = '{}.{}.tmp.npz'.format(fname[:-4], os.getpid())
+    np.savez(tmp, **arrays)
+    os.rename(tmp, fname)
+    purge(cache_dir(), max_bytes(), suffix=('.npz', '.sha1'), keep=fname)
+
+
+def purge(folder, max_bytes, prefix='', suffix='.npz', keep=None):
+    '''Remove the least recently used cache files over a total size.
+
+    Arguments
+    ---------
+    * folder: string - The cache folder.
+    * max_bytes: None or int - The size limit. None is no limit.
+    * prefix: string - Only the files that start with this are counted.
+    * suffix: string or tuple - Only the files that end with this are
+      counted.
+    * keep: None or string - A file that is never removed, e.g. the one that
+      was just written.
+    '''
+    if max_bytes is None:
+        return
+    caches = []
+    for name in os.listdir(folder):
+        # Skip the files that other processes are still writing
+        if not (name.startswith(prefix) and name.endswith(suffix)) or \
+                '.tmp' in name:
+            continue
+        fname = os.path.join(folder, name)
+        try:
+            stat = os.stat(fname)
+        except OSError:
+            continue
+        caches.append( (stat.st_mtime, stat.st_size, fname) )
+
+    total = sum(c[1] for c in caches)
+    for mtime, size, fname in sorted(caches):
+        if total <= max_bytes:
+            break
+        if fname == keep:
+            continue
+        try:
+            os.remove(fname)
+        except OSError:
+            continue
+        total -= size
@@ -5,17 +5,22 @@ from multiprocessing import Pool
 import numpy as np
 import tables as pyt
 import scipy.stats as sps
-import matplotlib.pyplot as plt
 
 #import chem.gcms as gcms
 import gcms
+import general
+import cache
+import library
+import profiling
+import plotting
+import h5tables
 
 # Get the command line arguments
 args = gcms.get_args()
 
-def cal_h5_build(args):
+def cal_h5_build(args, names):
     class CalTable( pyt.IsDescription ):
-        cpd = pyt.StringCol( 50, pos=0 )
+        cpd = pyt.StringCol( h5tables.string_width(names), pos=0 )
         int_start = pyt.Float64Col( pos=1 )
         int_stop = pyt.Float64Col( pos=2 )
         slope = pyt.Float64Col( pos=3 )
@@ -25,8 +30,9 @@ def cal_h5_build(args):
         stderr = pyt.Float64Col( pos=7 )
         refcol = pyt.Int16Col( pos=8 )
         
-    h5f = pyt.openFile(args.cal_name, 'w', 'GCMS Calibrations')
-    table = h5f.createTable('/', 'cals', CalTable, )
+    h5f = pyt.openFile(args.cal_name, 'w', 'GCMS Calibrations', 
+            filters=h5tables.filters(args.complib, args.complevel))
+    table = h5f.createTable('/', 'cals', CalTable, expectedrows=len(names))
 
     # Here I'm storing the background information in case I need to know
     # later.
@@ -62,113 +68,231 @@ def cal_file(fname):
 
 def aia_build(ref_file, args=args):
     print 'Processing:', ref_file
+    mark = profiling.summary()
 
-    aia = gcms.AIAFile( os.path.join(args.cal_folder, ref_file) )
+    aia = general.open_file( os.path.join(args.cal_folder, ref_file),
+            args.ref_name, 'nnls', storage=args.storage )
 
-    aia.ref_build(args.ref_name, bkg=args.nobkg,
-            bkg_time=float(args.bkg_time))
+    aia.ref_build(bkg=args.nobkg,
+            bkg_time=float(args.bkg_time), 
+            library=library.get_library())
 
-    aia.nnls()
+    aia.nnls(cache=args.cache)
 
+    # Plots are drawn later by the parent process. Only their data is kept.
+    aia.plots = []
     if args.cal_type == 'internal':
-        aia.integrate(args.std_start, args.std_stop)
+        std_ints, masks, sims = aia.integrate_many( 
+                [(args.std_start, args.std_stop)], sims=True )
         n = aia.ref_files.index( args.standard )
-        aia.std_int = aia.integral[n]
+        aia.std_int = std_ints[0, n]
         
-        mask = aia.last_int_mask
-        plt.plot(aia.times[mask], aia.tic[mask], 'k', lw=2)
-        plt.plot(aia.times[mask], aia.last_int_sim[:,n])
-        plt.savefig( os.path.join(args.cal_folder, ref_file[:-4]+'_std'), 
-                dpi=200)
-        plt.close()
+        mask = masks[0]
+        if plotting.wanted(ref_file, args.plots):
+            aia.plots.append( (plotting.fit_plot, 
+                (os.path.join(args.cal_folder, ref_file[:-4]+'_std'), 
+                [(aia.times[mask], sims[0][:,n])], 
+                (aia.times[mask], aia.tic[mask]), None, None, 2)) )
+
+    # Only the fit results are needed in the parent process, so don't send
+    # the intensity data or reload the file when unpickling
+    aia.pickle_mode = 'results'
+
+    aia.profile = None
+    if profiling.enabled():
+        aia.profile = profiling.summary(since=mark, fname=ref_file, 
+                kind='file')
 
     return aia
 
-def int_extract(name, info, aias, args):
-    ints = []
-    conc = []
-    if args.cal_type == 'internal':
-        stdint = []
-        stdcon = []
-
-    plt.figure()
-    for line in info:
-        aia = aias[ line[0] ]
-
-        start, stop = [float(i) for i in line[2:4]]
-        n = aia.ref_files.index(name)
-        aia.integrate(start, stop)
-
-        conc.append( line[1] )
-        ints.append( aia.integral[n] )
-        
-        mask = aia.last_int_mask
-        plt.plot(aia.times[mask], aia.last_int_sim[:,n])
-
-        if args.cal_type == 'internal':
-            stdcon.append( line[4] )
-            stdint.append( aia.std_int )
-
-    plt.xlim(start, stop)
-    plt.savefig(os.path.join(args.cal_folder, name+'_'+'fits'), dpi=200)
-    plt.close()
-
-    ints = np.array(ints, dtype=float)
-    conc = np.array(conc, dtype=float)
-    if args.cal_type == 'internal':
-        stdint = np.array(stdint, dtype=float)
-        stdcon = np.array(stdcon, dtype=float)
-        ints = ints/stdint
-        conc = conc/stdcon
-
-    slope, intercept, r, p, stderr = sps.linregress(conc, ints)
-    cal_plot(name, args, ints, conc, slope, intercept, r)
-
-    row = table.row
-    row['cpd'] = name
-    row['int_start'] = start
-    row['int_stop'] = stop
-    row['slope'] = slope
-    row['intercept'] = intercept
-    row['r'] = r
-    row['p'] = p
-    row['stderr'] = stderr
-    row['refcol'] = n
-    row.append()
-
-
-def cal_plot(name, args, ints, conc, slope, intercept, r):
-    plt.figure()
-    plt.plot(conc, slope*conc + intercept, 'k-')
-    plt.plot(conc, ints, 'o', ms=8)
-    text_string = 'Slope: {:.2f}\nIntercept: {:.2f}\nR^2: {:.5f}'
-    plt.text(0.5, ints.max()*0.8, text_string.format(slope, intercept, r**2))
-    plt.savefig(os.path.join(args.cal_folder, name+'_cal_curve'), dpi=200)
-    plt.close()
+def file_integrals(refs, aias):
+    # Integrate all of the calibration windows of each data file with one
+    # call. Returns a dictionary of the integrals, window masks, and simulated
+    # traces, keyed by the compound name and the index of the line in
+    # refs[name].
+    windows = {}
+    for name in refs:
+        for num, line in enumerate(refs[name]):
+            start, stop = [float(i) for i in line[2:4]]
+            windows.setdefault(line[0], []).append( (name, num, start, stop) )
+
+    results = {}
+    for fname, wins in windows.items():
+        ints, masks, sims = aias[fname].integrate_many( 
+                [w[2:] for w in wins], sims=True )
+        for win, integral, mask, sim in zip(wins, ints, masks, sims):
+            results[ win[:2] ] = (integral, mask, sim)
+
+    return results
+
+def int_matrix(names, refs, aias, file_ints, args):
+    # Build the (compounds x calibration samples) arrays of the integrals and
+    # concentrations. The compounds have different numbers of samples, so the
+    # arrays are padded, and valid marks the real entries. For the internal
+    # standard type, both are divided by the values of the standard.
+    nsamp = max(len(refs[name]) for name in names)
+    shape = (len(names), nsamp)
+    ints = np.zeros(shape)
+    conc = np.zeros(shape)
+    valid = np.zeros(shape, dtype=bool)
+    refcols = np.zeros(len(names), dtype=int)
+
+    for m, name in enumerate(names):
+        for num, line in enumerate(refs[name]):
+            aia = aias[ line[0] ]
+            n = aia.ref_files.index(name)
+            integral = file_ints[ (name, num) ][0]
+
+            ints[m, num] = integral[n]
+            conc[m, num] = float(line[1])
+            if args.cal_type == 'internal':
+                ints[m, num] /= aia.std_int
+                conc[m, num] /= float(line[4])
+            valid[m, num] = True
+        refcols[m] = n
+
+    return ints, conc, valid, refcols
+
+def linregress_many(x, y, valid):
+    '''Linear least squares fits of many data sets at once.
+
+    This gives the same results as ``scipy.stats.linregress`` for every row
+    of x and y, using only the entries where valid is True.
+
+    Returns
+    -------
+    slope, intercept, r, p, stderr: arrays - One value for every row.
+    '''
+    n = valid.sum(axis=1).astype(float)
+    x = np.where(valid, x, 0.)
+    y = np.where(valid, y, 0.)
+    xmean = x.sum(axis=1)/n
+    ymean = y.sum(axis=1)/n
+    xm = np.where(valid, x - xmean[:, np.newaxis], 0.)
+    ym = np.where(valid, y - ymean[:, np.newaxis], 0.)
+    ssxm = (xm*xm).sum(axis=1)/n
+    ssym = (ym*ym).sum(axis=1)/n
+    ssxym = (xm*ym).sum(axis=1)/n
+
+    r_den = np.sqrt(ssxm*ssym)
+    r = np.zeros_like(r_den)
+    nz = r_den != 0.
+    r[nz] = ssxym[nz]/r_den[nz]
+    # Test for numerical error propagation
+    r = np.clip(r, -1., 1.)
+
+    slope = ssxym/ssxm
+    intercept = ymean - slope*xmean
+
+    df = n - 2
+    TINY = 1.0e-20
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t = r*np.sqrt(df/((1.0 - r + TINY)*(1.0 + r + TINY)))
+        p = 2*sps.t.sf(np.abs(t), df)
+        stderr = np.sqrt((1 - r**2)*ssym/ssxm/df)
+
+    # Two points are always on the line
+    two = n == 2
+    if two.any():
+        p[two] = np.where(ym[two].any(axis=1), 0., 1.)
+        stderr[two] = 0.
+
+    return slope, intercept, r, p, stderr
+
+def cal_fits(refs, aias, file_ints, args):
+    # Fit the calibration curves of all compounds at once. Returns the rows
+    # of the cals table as a structured array, and the plot jobs.
+    names = list(refs)
+    ints, conc, valid, refcols = int_matrix(names, refs, aias, file_ints, 
+            args)
+    slope, intercept, r, p, stderr = linregress_many(conc, ints, valid)
+
+    rows = np.zeros(len(names), dtype=table.dtype)
+    rows['cpd'] = names
+    rows['slope'] = slope
+    rows['intercept'] = intercept
+    rows['r'] = r
+    rows['p'] = p
+    rows['stderr'] = stderr
+    rows['refcol'] = refcols
+    # The window of the last calibration line of each compound
+    for m, name in enumerate(names):
+        rows['int_start'][m], rows['int_stop'][m] = \
+                [float(i) for i in refs[name][-1][2:4]]
+
+    plots = []
+    for m, name in enumerate(names):
+        if not plotting.wanted(name, args.plots):
+            continue
+        traces = []
+        for num, line in enumerate(refs[name]):
+            aia = aias[ line[0] ]
+            integral, mask, sim = file_ints[ (name, num) ]
+            traces.append( (aia.times[mask], sim[:,refcols[m]]) )
+        good = valid[m]
+        plots.append( (plotting.fit_plot, 
+            (os.path.join(args.cal_folder, name+'_'+'fits'), traces, None,
+            None, (rows['int_start'][m], rows['int_stop'][m]))) )
+        plots.append( (plotting.cal_curve_plot, 
+            (os.path.join(args.cal_folder, name+'_cal_curve'), 
+            conc[m, good], ints[m, good], slope[m], intercept[m], r[m])) )
+
+    return rows, plots
 
 
 if __name__ == '__main__':
-    h5f, table = cal_h5_build(args)
-
+    batch_mark = profiling.summary()
     refs, ref_files = cal_file('calibration.csv')
 
-    gcms.clear_png(args.cal_folder)
+    h5f, table = cal_h5_build(args, list(refs))
+
+    if args.plots == []:
+        gcms.clear_png(args.cal_folder)
+
+    # Parse the reference file once, and share it with the workers
+    with profiling.phase('references'):
+        ref_lib = library.RefLibrary.load(args.ref_name).share()
 
     if args.nproc == 1:
+        library.pool_init(ref_lib)
         aias = [aia_build(i) for i in ref_files]
     else:
-        p = Pool(args.nproc)
+        p = Pool(args.nproc, initializer=library.pool_init, 
+                initargs=(ref_lib,))
         aias = p.map(aia_build, ref_files)
 
+    file_profs = [aia.profile for aia in aias if aia.profile is not None]
+    for prof in file_profs:
+        profiling.write(args.profile, prof)
+
     aias = dict( zip(ref_files, aias) )
+    file_ints = file_integrals(refs, aias)
 
-    for name in refs:
-        int_extract(name, refs[name], aias, args)
+    plot_jobs = []
+    for aia in aias.values():
+        plot_jobs.extend(aia.plots)
+
+    rows, plots = cal_fits(refs, aias, file_ints, args)
+    plot_jobs.extend(plots)
+    with profiling.phase('write'):
+        table.append(rows)
         h5f.flush()
 
+    if args.save_fits:
+        fit_filters = h5tables.filters(args.complib, args.complevel)
+        ref_hash = cache.file_hash(args.ref_name)
+        with profiling.phase('write'):
+            for aia in aias.values():
+                h5tables.fits_save(h5f, aia, fit_filters, 
+                        ref_name=args.ref_name, ref_hash=ref_hash, 
+                        bkg=args.nobkg, bkg_time=args.bkg_time)
+
     h5f.close()
-    
-    pyt.copyFile(args.cal_name, args.cal_name+'temp', overwrite=True)
-    os.remove(args.cal_name)
-    os.rename(args.cal_name+'temp', args.cal_name)
+
+    # All of the results are saved, so draw the plots
+    with profiling.phase('plot'):
+        plotting.render(plot_jobs, args.nproc)
+
+    if profiling.enabled():
+        gcms.profile_write(args, batch_mark, file_profs)
 
@@ -3,40 +3,51 @@ from multiprocessing import Pool
 
 import numpy as np
 import tables as pyt
-import matplotlib.pyplot as plt
 
 #import chem.gcms as gcms
 import gcms
+import general
+import cache
+import library
+import profiling
+import plotting
+import h5tables
 
 # Get the command line arguments
 args = gcms.get_args()
-
-# This function is from: http://stackoverflow.com/questions/434287
-def chunker(seq, size):
-    return (seq[pos:pos + size] for pos in xrange(0, len(seq), size))
-
+batch_mark = profiling.summary()
 
 def aia_proc(fname, args=args):
     print 'Processing:', fname
-    aia = gcms.AIAFile( os.path.join(args.data_folder, fname) )
-    aia.ref_build(args.ref_name, bkg=args.nobkg,
-            bkg_time=float(args.bkg_time) )
-    aia.nnls()
-
+    mark = profiling.summary()
+    aia = general.open_file( os.path.join(args.data_folder, fname),
+            args.ref_name, 'nnls', storage=args.storage )
+    aia.ref_build(bkg=args.nobkg,
+            bkg_time=float(args.bkg_time), 
+            library=library.get_library() )
+    aia.nnls(cache=args.cache)
+
+    # Integrate and quantify every calibrated compound. Only these small
+    # arrays (and the plot data) are sent back to the parent process, unless
+    # the fits are saved. Plots are drawn later by the parent process.
+    std_con = None
     if args.cal_type == 'internal':
-        aia.integrate(args.std_start, args.std_stop)
-        n = aia.ref_files.index( args.standard )
-        aia.std_int = aia.integral[n]
-        
-        mask = aia.last_int_mask
-        plt.plot(aia.times[mask], aia.last_int_sim[:,n])
-        plt.plot(aia.times[mask], aia.tic[mask], 'k', lw=1.5)
-        plt.savefig( 
-                os.path.join(args.data_folder, fname[:-4]+'_intstd'), 
-                dpi=200 )
-        plt.close()
-
-    return aia
+        std_con = std_cons[fname]
+    ints, concs, plots = gcms.quantitate(aia, fname, calib, args, std_con)
+
+    saved = None
+    if args.save_fits:
+        # Don't send the intensity data or reload the file when unpickling
+        aia.pickle_mode = 'results'
+        saved = aia
+
+    # The timings of this file only, even if the process handled others
+    prof = None
+    if profiling.enabled():
+        prof = profiling.summary(since=mark, fname=fname, kind='file')
+
+    return fname, ints, concs, prof, plots, saved
+
 
 # Open the calibration data file
 cal = pyt.openFile(args.cal_name)
@@ -44,102 +55,191 @@ cal_table = cal.root.cals
 
 gcms.table_check(cal_table, args)
 
-# Make a new hdf5 file for data from sample runs
-h5f = pyt.openFile(args.data_name, 'w', 'Catalytic Runs')
-
-cal_cpds = [i[0] for i in cal_table]
-col_dict = {cal_cpd: pyt.Float64Col() for cal_cpd in cal_cpds}
-col_dict['fname'] = pyt.StringCol(255, pos=0)
+def h5_build(args, cal_cpds, files, key):
+    # Make a new hdf5 file for data from sample runs
+    h5f = pyt.openFile(args.data_name, 'w', 'Catalytic Runs', 
+            filters=h5tables.filters(args.complib, args.complevel))
+
+    h5tables.results_build(h5f, cal_cpds, files, args.nobkg, args.bkg_time)
+    h5f.root.int_data.attrs.results_key = key
+
+    # The size and modification time of every processed data file, which
+    # is used to find new or modified files in incremental runs
+    info_dict = {'fname': pyt.StringCol(h5tables.string_width(files), pos=0),
+            'size': pyt.Int64Col(pos=1), 'mtime': pyt.Float64Col(pos=2)}
+    file_table = h5f.createTable('/', 'file_info', info_dict, 
+            "Processed Data Files", expectedrows=max(1, len(files)))
+    h5tables.index_columns(file_table, ['fname'])
+
+    return h5f
+
+
+def h5_reopen(args, cal_cpds, files, key):
+    # Open the existing hdf5 file for an incremental run. Returns None if
+    # there is no file, or if it was made with different calibrated compounds
+    # or background settings, or if a file name is too long for its tables.
+    # The results key also catches changed calibration lines, reference
+    # files, calibration types, or standard concentrations.
+    if not os.path.exists(args.data_name):
+        return None
+
+    h5f = pyt.openFile(args.data_name, 'a')
+    root = h5f.root
+    # The file_info table holds the file names, and the results tables the
+    # names without the extension
+    longest = max([len(f) for f in files] + [0,])
+    problem = None
+    if not all(t in root for t in ['int_data', 'conc_data', 'file_info']):
+        problem = 'is missing the int_data, conc_data, or file_info table.'
+    else:
+        attrs = root.int_data.attrs
+        cols = set(root.conc_data.colnames)
+        name_width = min(root.int_data.coldtypes['fname'].itemsize,
+                root.conc_data.coldtypes['fname'].itemsize)
+        if cols != set(cal_cpds + ['fname',]) or \
+                attrs.bkg != args.nobkg or \
+                attrs.bkg_time != args.bkg_time or \
+                getattr(attrs, 'results_key', None) != key:
+            problem = 'does not match the current calibration, reference, ' \
+                    'or background settings.\n(Use reintegrate.py to only ' \
+                    'apply new calibrations to saved fits.)'
+        elif root.file_info.coldtypes['fname'].itemsize < longest:
+            problem = 'has a file_info filename column that is too narrow ' \
+                    'for the longest data file name ({} characters).'.format(
+                    longest)
+        elif name_width < longest - 4:
+            problem = 'has an int_data/conc_data name column that is too ' \
+                    'narrow for the longest data file name ({} characters ' \
+                    'without the extension).'.format(longest - 4)
+
+    if problem is not None:
+        print 'Warning: The existing data file', problem
+        print 'All data files will be processed. (Fits are still loaded ' \
+                'from the fit cache\nif the references and background did ' \
+                'not change.)\n'
+        h5f.close()
+        return None
+
+    return h5f
+
+
+def file_changes(files, file_table, folder):
+    # Find the data files that are new, or whose size or modification time
+    # changed since they were last processed, and the processed files that
+    # are no longer in the folder.
+    old = {}
+    for row in file_table:
+        old[ row['fname'] ] = (row['size'], row['mtime'])
+
+    stats = {}
+    changed = []
+    for f in files:
+        stat = os.stat( os.path.join(folder, f) )
+        stats[f] = (stat.st_size, stat.st_mtime)
+        if old.get(f) != stats[f]:
+            changed.append(f)
+    removed = [f for f in old if f not in stats]
+
+    return changed, removed, stats
+
+
+# The calibration table is read once, as arrays
+cal_rows = cal_table[:]
+calib = gcms.Calibration(cal_rows)
+cal_cpds = calib.names
+key = gcms.results_key(args, cal_rows)
 
-col_dict2 = col_dict.copy()
-for cal_cpd in cal_cpds:
-    col_dict2[ cal_cpd+'_per' ] = pyt.Float64Col()
-col_dict2['cpd_name'] = pyt.StringCol(255, pos=1)
+files = os.listdir(args.data_folder)
+files = [f for f in files if f[-3:] == 'CDF']
 
-int_table = h5f.createTable('/', 'int_data', col_dict2, 
-        "Raw Integration Data")
-int_table.attrs.bkg = args.nobkg
-int_table.attrs.bkg_time = args.bkg_time
+h5f = None
+if args.incremental:
+    h5f = h5_reopen(args, cal_cpds, files, key)
+incremental = h5f is not None
+if not incremental:
+    h5f = h5_build(args, cal_cpds, files, key)
+
+int_table = h5f.root.int_data
+data_table = h5f.root.conc_data
+file_table = h5f.root.file_info
+
+files, removed, file_stats = file_changes(files, file_table, 
+        args.data_folder)
+print 'Files to process:', len(files)
+
+# Remove the old results of the files that are processed again, and of the
+# files that were deleted from the data folder
+if incremental:
+    if removed:
+        print 'Files removed from the data folder:', len(removed)
+    old = files + removed
+    names = [f[:-4] for f in old]
+    h5tables.remove_rows(data_table, 'fname', names)
+    h5tables.remove_rows(int_table, 'fname', names)
+    h5tables.remove_rows(file_table, 'fname', old)
+    h5tables.fits_remove(h5f, old)
+
+writer = h5tables.ResultWriter(h5f, cal_cpds)
+fit_filters = h5tables.filters(args.complib, args.complevel)
 
-data_table = h5f.createTable('/', 'conc_data', col_dict, 
-        "Concentration Data")
+if args.cal_type == 'internal':
+    std_cons = gcms.std_cons_read('data.csv')
 
 
-files = os.listdir(args.data_folder)
-files = [f for f in files if f[-3:] == 'CDF']
-if args.cal_type == 'internal':
-    std_cons = {}
-    f = open('data.csv')
-    next(f)
-    for line in f:
-        if line[0] == '#': continue
-        elif line.isspace(): continue
-        sp = line.split(',')
-        std_cons[sp[0]] = float(sp[1])
-    f.close()
+# Plots of unchanged files are kept for incremental runs, or if only some of
+# the files are plotted. The others are overwritten.
+if args.plots == [] and not incremental:
+    gcms.clear_png(args.data_folder)
 
 
-gcms.clear_png(args.data_folder)
+# The reference file is parsed once (or read from the cache), and the workers
+# share one read-only copy of the spectra
+with profiling.phase('references'):
+    ref_lib = library.RefLibrary.load(args.ref_name).share()
 
+# The files are streamed through the pool, and the results of each file are
+# buffered as soon as they arrive, and written in bulk. The workers are forked after the
+# calibration data is loaded, so they inherit it.
+if args.nproc > 1:
+    pool = Pool(args.nproc, initializer=library.pool_init, 
+            initargs=(ref_lib,))
+    results = pool.imap_unordered(aia_proc, files)
+else:
+    library.pool_init(ref_lib)
+    results = (aia_proc(f) for f in files)
+
+file_profs = []
+plot_jobs = []
+for f, ints, concs, prof, plots, saved in results:
+    with profiling.phase('write'):
+        writer.write(f, ints, concs, file_stats[f])
+        if saved is not None:
+            h5tables.fits_save(h5f, saved, fit_filters, ref_name=args.ref_name,
+                    ref_hash=cache.file_hash(args.ref_name), bkg=args.nobkg,
+                    bkg_time=args.bkg_time)
+    if prof is not None:
+        profiling.write(args.profile, prof)
+        file_profs.append(prof)
+    plot_jobs.extend(plots)
 
 if args.nproc > 1:
-    pool = Pool(args.nproc)
+    pool.close()
+    pool.join()
 
-for fs in chunker(files, args.nproc):
-    if args.nproc > 1:
-        aias = pool.map(aia_proc, fs)
-    else:
-        aias = [ aia_proc(fs[0]), ]
-
-    for aia in aias:
-        f = os.path.split(aia.filename)[-1]
-        name = f[:-4]
-    
-        row = data_table.row
-        row['fname'] = name
-    
-        for cpd in cal_table:
-            cpd_name = cpd[0]
-            start, stop = cpd[1], cpd[2]
-            slope, intercept = cpd[3], cpd[4]
-            column = cpd[8]
-    
-            aia.integrate( start, stop )
-            ints = aia.integral
-            ints_sum = ints.sum()
-            int_row = int_table.row
-            int_row['fname'] = name
-            int_row['cpd_name'] = cpd_name
-    
-            for n, cal_cpd in enumerate(cal_cpds):
-                int_row[ cal_cpd ] = ints[n]
-                int_row[ cal_cpd+'_per' ] = ints[n]/ints_sum
-            int_row.append()
-            
-            if args.cal_type == 'internal':
-                int_adj = ints[column]/aia.std_int
-                conc = (int_adj - intercept)/slope
-                conc = conc*std_cons[f]
-            else:
-                conc = (ints[column] - intercept)/slope
-
-            row[ cpd_name ] = conc
-   
-            mask = aia.last_int_mask
-            plt.plot(aia.times[mask], aia.last_int_sim[:,column])
-            plt.plot(aia.times[mask], aia.tic[mask], 'k', lw=1.5)
-            plt.title('Concentration = {:.2f}'.format(conc))
-            plt.savefig( 
-                    os.path.join(args.data_folder, name+'_'+cpd_name), 
-                    dpi=200 )
-            plt.close()
-    
-        row.append()
-        h5f.flush()
+with profiling.phase('write'):
+    writer.flush()
 
 cal.close()
 h5f.close()
 
-pyt.copyFile(args.data_name, args.data_name+'temp', overwrite=True)
-os.remove(args.data_name)
-os.rename(args.data_name+'temp', args.data_name)
+# Only the removed rows and fits of an incremental run leave unused space
+if args.compact and incremental:
+    with profiling.phase('write'):
+        h5tables.compact(args.data_name)
+
+# All of the results are saved, so draw the plots
+with profiling.phase('plot'):
+    plotting.render(plot_jobs, args.nproc)
+
+if profiling.enabled():
+    gcms.profile_write(args, batch_mark, file_profs)
@@ -1,9 +1,20 @@
-import itertools as it
+import os
+import time
+import hashlib
+import tempfile
+import threading
 
 import numpy as np
+import scipy.sparse as sparse
 import netCDF4 as cdf
 
 import general 
+import cache
+import profiling
+
+# The netCDF/HDF5 libraries are not thread safe, so all reads of scan data
+# from worker threads go through this lock
+_CDF_LOCK = threading.Lock()
 
 class GcmsMeta(type):
     '''Generic Metaclass for GCMS data files.'''
@@ -16,28 +27,194 @@ class GcmsFile(object):
     
     This object is meant to be subclassed and can't be instantiated directly.
     '''
-    def __init__(self, fname, refs=None):
+    # Number of scans that are read from disk at one time when the intensity
+    # data is built lazily
+    chunk_scans = 1000
+    # Folder for the memory-mapped intensity caches. None uses the system
+    # temporary folder, and the cache files are deleted by ``close`` or when
+    # the object is garbage collected. The caches in a set folder are kept,
+    # so later runs reuse them, and the oldest are removed once the folder
+    # holds more than ``cache_max_bytes`` (None is no limit).
+    cache_dir = None
+    cache_max_bytes = 10*1024**3
+    # How objects are pickled, e.g. to send them between processes.
+    # - 'reload': Only the file names and the derived attributes are saved,
+    #   and the data and reference files are read again on unpickling.
+    # - 'arrays': All of the arrays, including the intensity data, are saved
+    #   and restored without reading any files. With pickle protocol 5, the
+    #   arrays can be sent as out-of-band buffers.
+    # - 'results': Like 'arrays', but without the intensity data. This is a
+    #   compact view with the times, tic, references, and fits.
+    pickle_mode = 'reload'
+
+    def __init__(self, fname, refs=None, storage='dense'):
         '''
         Arguments
         ---------
         * fname: string - The name of the GCMS data file.
         * refs: None (default) or string: If string is given, this will be
         processed as a reference file for fitting.
+        * storage: string - How the intensity data is held in memory.
+            - 'dense' (default): The full intensity array is read on load.
+            - 'lazy': Only times, masses, and tic are computed on load,
+              one chunk of scans at a time. The intensity array is written
+              to a memory-mapped cache file on first access, or can be read
+              per time window with ``intensity_window``.
+            - 'sparse': The intensity data is stored as a scipy.sparse CSR
+              matrix, which only holds the non-empty mass bins.
         '''
+        if storage not in ('dense', 'lazy', 'sparse'):
+            raise ValueError("Unknown storage type: {}".format(storage))
 
         self.filename = fname
+        self._storage = storage
+        self._intensity = None
+        self._cache_file = None
         self._file_proc()
         if refs:
             self._ref_file = refs
             self.ref_build()
 
     def __reduce__(self,):
+        '''Pickle support. See ``pickle_mode`` for the options.'''
+        if self.pickle_mode not in ('reload', 'arrays', 'results'):
+            raise ValueError("Unknown pickle mode: {}".format(
+                self.pickle_mode))
+
         save_dict = self.__dict__.copy()
+        # Only this object deletes the cache file that it wrote
+        save_dict.pop('_cache_file', None)
         
-        rem = ['filename', 'intensity', 'masses', 'tic', 'times']
-        [save_dict.pop(r) for r in rem]
+        if self.pickle_mode == 'reload':
+            rem = ['filename', '_intensity', 'masses', 'tic', 'times']
+            [save_dict.pop(r) for r in rem]
+
+            if hasattr(self, '_reconstruct'):
+                return (general.open_file, tuple(self._reconstruct), 
+                        save_dict)
+            return (self.__class__, (self.filename, None, self._storage), 
+                    save_dict)
+
+        # The other modes restore the saved attributes without reading any
+        # files. The results view drops the intensity array, which is
+        # rebuilt from the data file if it is used again (as for lazy
+        # storage).
+        if self.pickle_mode == 'results':
+            save_dict['_intensity'] = None
+
+        if hasattr(self, '_reconstruct'):
+            return (general.gcms_rebuild, (self._reconstruct,), save_dict)
+        return (_gcms_new, (self.__class__,), save_dict)
+
+    def __del__(self, ):
+        try:
+            self.close()
+        except Exception:
+            pass
+
+    def close(self, ):
+        '''Release the memory-mapped intensity cache of lazy storage.
+
+        The cache file is deleted if this object wrote it to the system
+        temporary folder. The intensity array is built again if it is used
+        after this.
+        '''
+        if self._storage == 'lazy':
+            self._intensity = None
+        fname = getattr(self, '_cache_file', None)
+        self._cache_file = None
+        if fname is not None:
+            try:
+                os.remove(fname)
+            except OSError:
+                pass
 
-        return (general.open_file, tuple(self._reconstruct), save_dict)
+    @property
+    def intensity(self, ):
+        '''The 2D intensity array (scans x masses).
+
+        For lazy storage, this is built on first access and is a read-only
+        memory-mapped array. For sparse storage, this is a CSR matrix.
+        '''
+        if self._intensity is None:
+            self._intensity = self._intensity_build()
+        return self._intensity
+
+    @intensity.setter
+    def intensity(self, value):
+        self._intensity = value
+
+    def intensity_rows(self, first, last):
+        '''Return the intensity rows for scans ``first`` up to ``last``.
+
+        The rows are always returned as a dense array. For lazy storage, only
+        these scans are read from the data file if the full intensity array
+        has not been built yet. For sparse storage, only these rows are
+        densified.
+        '''
+        if self._storage == 'sparse':
+            return self.intensity[first:last].toarray()
+        elif self._intensity is not None:
+            return self._intensity[first:last]
+        return self._rows_build(first, last)
+
+    def intensity_window(self, start, stop):
+        '''Return the intensity rows for the times between start and stop.
+
+        The rows correspond to ``self.times[(self.times > start) &
+        (self.times < stop)]``.
+        '''
+        idx = np.flatnonzero( (self.times > start) & (self.times < stop) )
+        if idx.size == 0:
+            return np.zeros((0, self.masses.size), dtype=float)
+        return self.intensity_rows(idx[0], idx[-1] + 1)
+
+    def _intensity_build(self, ):
+        '''Open the intensity array as a memory-mapped cache file.
+
+        The cache file is written if it doesn't exist, e.g. after ``close``.
+        Sparse data is read back into a sparse matrix instead.
+        '''
+        if self._storage == 'sparse':
+            return self._sparse_build()
+
+        fname = self._cache_name()
+        if not os.path.exists(fname):
+            self._cache_write(fname)
+        return _cache_open(fname)
+
+    def _cache_write(self, fname):
+        '''Read and bin all of the scans into a new intensity cache file.
+
+        The scans are written one chunk at a time, so the full array is never
+        in memory.
+        '''
+        tmp = '{}.{}.tmp'.format(fname, os.getpid())
+        shape = (self.times.size, self.masses.size)
+        mmap = np.lib.format.open_memmap(tmp, mode='w+', dtype=float,
+                shape=shape)
+        for first in range(0, shape[0], self.chunk_scans):
+            last = min(first + self.chunk_scans, shape[0])
+            mmap[first:last] = self._rows_build(first, last)
+        mmap.flush()
+        del mmap
+        os.rename(tmp, fname)
+
+        if self.cache_dir is None:
+            self._cache_file = fname
+        else:
+            cache.purge(self.cache_dir, self.cache_max_bytes, prefix='gcms_',
+                    suffix='.npy', keep=fname)
+
+    def _cache_name(self, ):
+        stat = os.stat(self.filename)
+        key = '{}:{}:{}'.format(os.path.abspath(self.filename), stat.st_size,
+                stat.st_mtime)
+        digest = hashlib.md5( key.encode('utf-8') ).hexdigest()
+
+        base = os.path.splitext( os.path.basename(self.filename) )[0]
+        folder = self.cache_dir or tempfile.gettempdir()
+        return os.path.join(folder, 'gcms_{}_{}.npy'.format(base, digest))
 
 
 class AIAFile(GcmsFile):
@@ -45,62 +222,263 @@ class AIAFile(GcmsFile):
 
     This subclass reads GCMS data from an AIA (CDF) file type.
     '''
-    def _groupkey(self, x):
-        return x[0]
-
+    @profiling.timed('load')
     def _file_proc(self, ):
         data = cdf.Dataset(self.filename)
 
         points = data.variables['point_count'][:]
+        self._offsets = np.append(0, np.cumsum(points))
 
         times_cdf = data.variables['scan_acquisition_time']
         times = times_cdf[:]/60.
 
-        mass_cdf = data.variables['mass_values'][:]
-        mass_min = np.int( np.round( mass_cdf.min() ) )
-        mass_max = np.int( np.round( mass_cdf.max() ) )
-        masses = np.arange(mass_min, mass_max +1)
-        
-        inten_cdf = data.variables['intensity_values'][:]
-
-        intens = []
-        start = 0
-        
-        for point in points:
-            int_zero = np.zeros(masses.size, dtype=float)
-            
-            if point == 0: 
-                intens.append( int_zero )
-                continue
-                
-            mass_tmp = np.round( mass_cdf[start:start+point] ).astype(int)
-            ints_tmp = inten_cdf[start:start+point]
-            
-            mass_tmp2 = []
-            ints_tmp2 = []
-            for mass, mass_int in it.groupby( zip(mass_tmp, ints_tmp),
-                    key=self._groupkey):
-                ints = [i[1] for i in mass_int]
-                if len(ints) > 1:
-                    ints = np.array( ints ).mean()
-                else:
-                    ints = ints[0]
-                mass_tmp2.append(mass)
-                ints_tmp2.append(ints)
-            mass_tmp2 = np.array(mass_tmp2)
-            ints_tmp2 = np.array(ints_tmp2)
-                    
-            mask = mass_tmp2 - mass_min
-            int_zero[mask] = ints_tmp2
-
-            intens.append( int_zero )
-
-            start += point
+        if self._storage in ('dense', 'sparse'):
+            mass_cdf = np.asarray( data.variables['mass_values'][:] )
+            inten_cdf = np.asarray( data.variables['intensity_values'][:] )
+            mass_min = mass_cdf.min()
+            mass_max = mass_cdf.max()
+            profiling.count('bytes_read', mass_cdf.nbytes + inten_cdf.nbytes)
+        else:
+            mass_min, mass_max, tic = self._chunk_scan(data)
 
         data.close()
+        profiling.count('bytes_read', points.nbytes + times.nbytes)
+        profiling.count('scans', times.size)
+
+        mass_min = int( np.round( mass_min ) )
+        mass_max = int( np.round( mass_max ) )
+        masses = np.arange(mass_min, mass_max +1)
         
-        self.intensity = np.array(intens)
         self.times = times
         self.masses = masses
 
-        self.tic = self.intensity.sum(axis=1)
+        if self._storage == 'dense':
+            self.intensity = self._bin_rows(points, mass_cdf, inten_cdf)
+            self.tic = self.intensity.sum(axis=1)
+        elif self._storage == 'sparse':
+            self.intensity = self._bin_sparse(points, mass_cdf, inten_cdf)
+            self.tic = np.asarray( self.intensity.sum(axis=1) ).ravel()
+        else:
+            self.tic = tic
+
+    def _chunk_scan(self, data):
+        '''Find the mass range and the tic one chunk of scans at a time.
+
+        The tic is the sum of the nominal mass bins of each scan, the same as
+        the row sums of the intensity array, but the bins are never put into
+        an array.
+        '''
+        mass_var = data.variables['mass_values']
+        inten_var = data.variables['intensity_values']
+        nscans = self._offsets.size - 1
+        tic = np.zeros(nscans, dtype=float)
+
+        mins = []
+        maxs = []
+        for first in range(0, nscans, self.chunk_scans):
+            last = min(first + self.chunk_scans, nscans)
+            lo, hi = self._offsets[first], self._offsets[last]
+            if hi == lo: continue
+            mass_cdf = np.asarray( mass_var[lo:hi] )
+            inten_cdf = np.asarray( inten_var[lo:hi] )
+            profiling.count('bytes_read', mass_cdf.nbytes + inten_cdf.nbytes)
+            mins.append( mass_cdf.min() )
+            maxs.append( mass_cdf.max() )
+
+            points = np.diff( self._offsets[first:last+1] )
+            scans, cols, ints = _scan_bins(points, mass_cdf, inten_cdf, 0)
+            tic[first:last] = np.bincount(scans, weights=ints, 
+                    minlength=last - first)
+
+        return min(mins), max(maxs), tic
+
+    def _rows_build(self, first, last):
+        '''Read and bin the scans from ``first`` up to ``last``.'''
+        last = min(last, self.times.size)
+        lo, hi = self._offsets[first], self._offsets[last]
+
+        with _CDF_LOCK:
+            data = cdf.Dataset(self.filename)
+            mass_cdf = np.asarray( data.variables['mass_values'][lo:hi] )
+            inten_cdf = np.asarray( data.variables['intensity_values'][lo:hi] )
+            data.close()
+        profiling.count('bytes_read', mass_cdf.nbytes + inten_cdf.nbytes)
+
+        points = np.diff( self._offsets[first:last+1] )
+        return self._bin_rows(points, mass_cdf, inten_cdf)
+
+    def _sparse_build(self, ):
+        '''Read all of the scans into a sparse intensity matrix.'''
+        with _CDF_LOCK:
+            data = cdf.Dataset(self.filename)
+            mass_cdf = np.asarray( data.variables['mass_values'][:] )
+            inten_cdf = np.asarray( data.variables['intensity_values'][:] )
+            data.close()
+        profiling.count('bytes_read', mass_cdf.nbytes + inten_cdf.nbytes)
+
+        return self._bin_sparse(np.diff(self._offsets), mass_cdf, inten_cdf)
+
+    def _bin_rows(self, points, mass_cdf, inten_cdf):
+        '''Build dense intensity rows for a set of consecutive scans.'''
+        scans, cols, ints = _scan_bins(points, mass_cdf, inten_cdf, 
+                self.masses[0])
+        intensity = np.zeros((len(points), self.masses.size), dtype=float)
+        intensity[scans, cols] = ints
+        return intensity
+
+    def _bin_sparse(self, points, mass_cdf, inten_cdf):
+        '''Build a CSR intensity matrix for a set of consecutive scans.
+
+        The nominal mass bins come out of ``_scan_bins`` sorted by scan, so
+        the CSR arrays are filled directly without an intermediate dense or
+        COO matrix.
+        '''
+        scans, cols, ints = _scan_bins(points, mass_cdf, inten_cdf, 
+                self.masses[0])
+        counts = np.bincount(scans, minlength=len(points))
+        indptr = np.append(0, np.cumsum(counts))
+        shape = (len(points), self.masses.size)
+        return sparse.csr_matrix((ints.astype(float), cols, indptr), 
+                shape=shape)
+
+
+def _cache_open(fname):
+    '''Memory-map a cache file. The time stamp is updated for the purge.'''
+    os.utime(fname, None)
+    return np.load(fname, mmap_mode='r')
+
+
+def _gcms_new(cls):
+    '''Make an empty GCMS object of a class without reading any files.'''
+    return cls.__new__(cls)
+
+
+def cdf_scans(fname, masses, first=0, chunk_scans=500, poll=None, 
+        idle=60.):
+    '''Read the scans of an AIA (CDF) file in blocks, as they are written.
+
+    The file is opened again for every block, so the scans that are added
+    while a run is still acquired are picked up. A scan is only read once
+    all of its points are in the file. This is meant to feed a
+    ``StreamingNnls`` fit.
+
+    Arguments
+    ---------
+    * fname: string - The name of the CDF file.
+    * masses: array - The nominal masses of the intensity columns, e.g. the
+      masses of the prepared reference array. Points outside of this range
+      are dropped.
+    * first: int - The first scan to read.
+    * chunk_scans: int - The maximum number of scans in a block.
+    * poll: None (default) or float - The seconds to wait before checking
+      for new scans. If None, the iteration stops at the end of the file.
+    * idle: float - Stop after waiting this many seconds without a new scan.
+
+    Yields
+    ------
+    * times: array - The scan times in minutes.
+    * intensity: array - The intensities of the scans (scans x masses).
+    '''
+    masses = np.asarray(masses)
+    scan = first
+    waited = 0.
+    while True:
+        block = _cdf_block(fname, masses, scan, chunk_scans)
+        if block is not None:
+            scan += block[0].size
+            waited = 0.
+            yield block
+            continue
+
+        if poll is None or waited >= idle:
+            return
+        time.sleep(poll)
+        waited += poll
+
+
+def _cdf_block(fname, masses, first, nscans):
+    '''Read and bin up to nscans complete scans, or None if there are none.'''
+    with _CDF_LOCK:
+        data = cdf.Dataset(fname)
+        try:
+            var = data.variables
+            stop = min(first + nscans, len(var['point_count']))
+            if stop <= first:
+                return None
+            index = np.asarray(var['scan_index'][first:stop], dtype=int)
+            points = np.asarray(var['point_count'][first:stop], dtype=int)
+            times = np.asarray(var['scan_acquisition_time'][first:stop], 
+                    dtype=float)/60.
+
+            # Only keep the scans whose points are all written
+            written = min(len(var['mass_values']), 
+                    len(var['intensity_values']))
+            bad = np.flatnonzero( (index < 0) | (points < 0) | 
+                    (index + points > written) )
+            count = bad[0] if bad.size else index.size
+            if count == 0:
+                return None
+            index, points, times = index[:count], points[:count], \
+                    times[:count]
+
+            lo, hi = index[0], index[-1] + points[-1]
+            mass_cdf = np.asarray( var['mass_values'][lo:hi] )
+            inten_cdf = np.asarray( var['intensity_values'][lo:hi] )
+        finally:
+            data.close()
+    profiling.count('bytes_read', mass_cdf.nbytes + inten_cdf.nbytes)
+
+    scans, cols, ints = _scan_bins(points, mass_cdf, inten_cdf, masses[0])
+    keep = (cols >= 0) & (cols < masses.size)
+    intensity = np.zeros((count, masses.size), dtype=float)
+    intensity[scans[keep], cols[keep]] = ints[keep]
+    return times, intensity
+
+
+def _scan_bins(points, mass_values, intensity_values, mass_min):
+    '''Reduce the ragged AIA scan arrays to nominal mass bins.
+
+    The masses of every scan are rounded to integers, and consecutive points
+    in a scan with the same nominal mass are averaged together. This is done
+    for all of the scans at once using the cumulative scan offsets from
+    ``point_count``.
+
+    Arguments
+    ---------
+    * points: array - The number of data points in each scan.
+    * mass_values: array - The concatenated mass values for all scans.
+    * intensity_values: array - The concatenated intensities for all scans.
+    * mass_min: int - The nominal mass that corresponds to column 0.
+
+    Returns
+    -------
+    * scans: int array - The scan (row) index of each bin.
+    * cols: int array - The mass (column) index of each bin.
+    * ints: array - The averaged intensity of each bin.
+    '''
+    points = np.asarray(points, dtype=int)
+    offsets = np.cumsum(points)
+    npts = offsets[-1] if offsets.size else 0
+    if npts == 0:
+        return (np.zeros(0, dtype=int), np.zeros(0, dtype=int), 
+                np.zeros(0, dtype=float))
+
+    scans = np.repeat(np.arange(points.size), points)
+    cols = np.round(mass_values[:npts]).astype(int) - mass_min
+    intensity_values = intensity_values[:npts]
+
+    # A new bin starts at every scan offset and everywhere the nominal mass
+    # changes inside a scan. These are the same runs that were previously
+    # collected with itertools.groupby.
+    new = np.empty(npts, dtype=bool)
+    new[0] = True
+    new[1:] = cols[1:] != cols[:-1]
+    new[offsets[:-1][points[1:] != 0]] = True
+    starts = np.flatnonzero(new)
+
+    # Sum in the native data type so that the averages match ndarray.mean
+    counts = np.diff( np.append(starts, npts) )
+    sums = np.add.reduceat(intensity_values, starts)
+    ints = sums/counts.astype(sums.dtype)
+
+    return scans[starts], cols[starts], ints
@@ -3,6 +3,7 @@
 import os
 import argparse
 import re
+import hashlib
 from codecs import open
 import itertools as it
 
@@ -10,6 +11,11 @@ import numpy as np
 import netCDF4 as cdf
 import scipy.optimize as spo
 
+import cache
+import profiling
+import h5tables
+import plotting
+
 
 #### General Functions ####
 
@@ -68,7 +74,227 @@ def get_args():
             help='The stop time for integration of the internal standard. \
             Only valid if cal_type == "internal".')
 
-    return parser.parse_args()
+    parser.add_argument('--storage', default='dense', 
+            choices=['dense', 'lazy', 'sparse'],
+            help='How the MS intensity data is held in memory. dense = Read \
+            the full data set on load; lazy = Build the data on first use as \
+            a memory-mapped file, which reduces the memory used by each \
+            process; sparse = Store only the non-empty mass bins.')
+
+    parser.add_argument('--nocache', dest='cache', action='store_false',
+            help='Do not use the on-disk cache of fit results. Fits that \
+            are already cached for the same data file, reference file, and \
+            background settings are otherwise reused.')
+
+    parser.add_argument('--incremental', action='store_true',
+            help='Only process the data files that are new or were modified \
+            since the last run, and keep the results of the other files in \
+            the existing data HDF file.')
+
+    parser.add_argument('--save_fits', action='store_true',
+            help='Save the times, TIC, fits, and references of every data \
+            file in the HDF file. The results can then be recomputed with \
+            reintegrate.py, e.g. after the integration windows change, \
+            without reading or fitting the data files again.')
+
+    parser.add_argument('--compact', action='store_true',
+            help='Rewrite the data HDF file at the end of an incremental or \
+            reintegrate.py run. HDF5 does not reuse the space of the rows \
+            and fits that are replaced, so the file otherwise grows with \
+            every run.')
+
+    parser.add_argument('--complib', default='blosc', 
+            choices=h5tables.COMPLIBS,
+            help='The compression library of the HDF5 result tables.')
+
+    parser.add_argument('--complevel', default=5, type=int, 
+            choices=range(10),
+            help='The compression level (0-9) of the HDF5 result tables.')
+
+    parser.add_argument('--plots', nargs='*', default=None, 
+            metavar='PATTERN',
+            help='Save plots of the fits and calibration curves. The plots \
+            are drawn after all of the results are saved, using nproc \
+            processes. Give file or compound name patterns (e.g. \
+            "run1*.CDF") to only plot those. No plots are made by default.')
+
+    parser.add_argument('--profile', default=None,
+            help='Time the stages of the processing, and append a JSON \
+            summary for every data file and for the whole batch to this \
+            file. Profiling is also turned on by setting the \
+            GCMSTOOLS_PROFILE environment variable, which writes to \
+            profile.jsonl.')
+
+    args = parser.parse_args()
+
+    # Turn on profiling before any worker processes are started
+    if args.profile:
+        profiling.enable()
+    elif profiling.enabled():
+        args.profile = 'profile.jsonl'
+
+    return args
+
+
+def std_cons_read(fname='data.csv'):
+    # Read the internal standard concentration of every data file
+    std_cons = {}
+    f = open(fname)
+    next(f)
+    for line in f:
+        if line[0] == '#': continue
+        elif line.isspace(): continue
+        sp = line.split(',')
+        std_cons[sp[0]] = float(sp[1])
+    f.close()
+    return std_cons
+
+
+def results_key(args, cal_rows, std_file='data.csv'):
+    '''A hash of the settings that the sample results depend on.
+
+    This covers the rows of the calibration table, the contents of the
+    reference file, and the calibration type. For internal calibrations, it
+    also covers the standard integration times and the standard
+    concentration file. The key is saved with the results, so incremental
+    runs can tell if the old results are still valid.
+
+    Arguments
+    ---------
+    * args: Namespace - The command line arguments.
+    * cal_rows: structured array - The rows of the 'cals' table.
+    * std_file: string - The file of internal standard concentrations.
+    '''
+    cal_hash = hashlib.sha1( np.ascontiguousarray(cal_rows).tobytes() )
+    parts = [cal_hash.hexdigest(), cache.file_hash(args.ref_name), 
+            args.cal_type]
+    if args.cal_type == 'internal':
+        parts.extend([float(args.std_start), float(args.std_stop),
+            cache.file_hash(std_file)])
+    return cache.cache_key(*parts)
+
+
+class Calibration(object):
+    '''The calibration table as arrays.
+
+    The table is read once, and the concentrations of all of the compounds
+    in a data file are then found with a few array operations.
+
+    Arguments
+    ---------
+    * cal_rows: structured array - The rows of the 'cals' table.
+    '''
+    def __init__(self, cal_rows):
+        self.names = [str(name) for name in cal_rows['cpd']]
+        self.int_start = cal_rows['int_start'].astype(float)
+        self.int_stop = cal_rows['int_stop'].astype(float)
+        self.slope = cal_rows['slope'].astype(float)
+        self.intercept = cal_rows['intercept'].astype(float)
+        self.refcol = cal_rows['refcol'].astype(int)
+        # The integration window of every compound
+        self.windows = np.column_stack( (self.int_start, self.int_stop) )
+
+    def concentrations(self, ints, std_int=None, std_con=None):
+        '''The concentrations of all of the compounds in a data file.
+
+        Arguments
+        ---------
+        * ints: array - The integrals of the compound windows (compounds x
+          refs), e.g. from ``integrate_many(self.windows)``.
+        * std_int: None or float - The integral of the internal standard.
+          The integrals are divided by this value.
+        * std_con: None or float - The concentration of the internal
+          standard, which multiplies the concentrations.
+        '''
+        vals = ints[np.arange(len(self.names)), self.refcol]
+        if std_int is not None:
+            vals = vals/std_int
+        concs = (vals - self.intercept)/self.slope
+        if std_con is not None:
+            concs = concs*std_con
+        return concs
+
+
+def quantitate(fit, fname, calib, args, std_con=None):
+    '''Integrate the calibrated compounds of a fit, and find their
+    concentrations.
+
+    This is used by data.py for new fits and by reintegrate.py for saved
+    fits.
+
+    Arguments
+    ---------
+    * fit: GCMS object - A fit data file, or a saved ``StoredFit``.
+    * fname: string - The data file name.
+    * calib: Calibration - The calibration table arrays.
+    * args: Namespace - The command line arguments.
+    * std_con: None or float - The internal standard concentration of this
+      file, for the 'internal' calibration type.
+
+    Returns
+    -------
+    * ints: array - The integrals of every compound window (compounds x
+      refs).
+    * concs: array - The concentration of every compound.
+    * plots: list - The plot jobs for ``plotting.render``. It is empty unless
+      the file should be plotted (see ``--plots``).
+    '''
+    plots = []
+    plot = plotting.wanted(fname, args.plots)
+    name = fname[:-4]
+
+    # All of the windows are integrated at once, with the internal standard
+    # window last
+    windows = calib.windows
+    if args.cal_type == 'internal':
+        windows = np.vstack( (windows, [(args.std_start, args.std_stop)]) )
+    if plot:
+        ints, masks, sims = fit.integrate_many(windows, sims=True)
+    else:
+        ints = fit.integrate_many(windows)
+
+    std_int = None
+    if args.cal_type != 'internal':
+        std_con = None
+    else:
+        n = fit.ref_files.index( args.standard )
+        std_int = ints[-1, n]
+        ints = ints[:-1]
+        if plot:
+            mask = masks[-1]
+            plots.append( (plotting.fit_plot, 
+                (os.path.join(args.data_folder, name+'_intstd'),
+                [(fit.times[mask], sims[-1][:,n])], 
+                (fit.times[mask], fit.tic[mask]))) )
+
+    concs = calib.concentrations(ints, std_int, std_con)
+
+    if plot:
+        for cpd_name, column, conc, mask, sim in zip(calib.names, 
+                calib.refcol, concs, masks, sims):
+            plots.append( (plotting.fit_plot, 
+                (os.path.join(args.data_folder, name+'_'+cpd_name),
+                [(fit.times[mask], sim[:,column])], 
+                (fit.times[mask], fit.tic[mask]),
+                'Concentration = {:.2f}'.format(conc))) )
+
+    return ints, concs, plots
+
+
+def profile_write(args, mark, file_profs):
+    # Write the profiling summary of a whole batch. With more than one
+    # process, the files are profiled in the workers, and their summaries are
+    # added to the work done in this process (reading the references,
+    # writing the results). Otherwise, this process did all of the work.
+    local = profiling.summary(since=mark)
+    if args.nproc > 1:
+        summaries = file_profs + [local,]
+    else:
+        summaries = [local,]
+    batch = profiling.combine(summaries, wall_time=local['wall_time'], 
+            files=len(file_profs), nproc=args.nproc, kind='batch')
+    profiling.write(args.profile, batch)
+    return batch
 
 
 def table_check(table, args):
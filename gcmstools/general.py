@@ -38,26 +38,56 @@ def get_sample_data(fname=None):
             name in fnames]
     
 
-def open_file(fname, refs=None, fit=None):
+def open_file(fname, refs=None, fit=None, storage='dense'):
     '''Function to construct GCMS file object.
 
     Arguments
     ---------
     * fname: string - The name of the GCMS data file.
     * refs: string - The name of a reference file for fitting.
-    * fit: string - The type of fitting to use on the data.
+    * fit: string - The type of fitting to use on the data. If the data was
+      already fit with the default settings, the fits are loaded from the
+      cache.
         - 'nnls': non-negative least squares
+    * storage: string - How the intensity data is stored.
+        - 'dense' (default): Read the full intensity array on load.
+        - 'lazy': Build the intensity array on first access as a
+          memory-mapped cache file.
+        - 'sparse': Store the intensity data as a CSR sparse matrix.
     '''
+    reconstruct = [fname, refs, fit, storage]
+
+    # This is a constructor for the dynamic GCMS class
+    newobj = _gcms_class(fname, refs, fit)
+    instance = newobj(fname, refs, storage)
+    instance._reconstruct = reconstruct
+    if refs:
+        instance._ref_file = refs
+        # Pick up the fits of an earlier default fit of these files
+        if fit and fit.lower() == 'nnls':
+            instance._fit_cache_load( instance._fit_key() )
+    return instance
+
+
+def gcms_rebuild(reconstruct):
+    '''Make an empty GCMS object without reading any files.
+
+    This is used to unpickle objects. The ``reconstruct`` list holds the
+    arguments that were given to ``open_file``.
+    '''
+    newobj = _gcms_class(*reconstruct[:3])
+    return newobj.__new__(newobj)
+
+
+def _gcms_class(fname, refs=None, fit=None):
+    '''Build the dynamic GCMS class for a data, reference, and fit type.'''
     objects = []
-    names = []
-    reconstruct = [fname,]
 
     filetype = fname[-3:].lower()
     if filetype == 'cdf':
         objects.append(filetypes.AIAFile)
    
     if refs:
-        reconstruct.append( refs )
         reffiletype = refs[-3:].lower()
         if reffiletype == 'txt':
             objects.append(reference.TxtReference)
@@ -66,14 +96,7 @@ def open_file(fname, refs=None, fit=None):
 
     if fit:
         fit = fit.lower()
-        reconstruct.append( fit )
         if fit == 'nnls':
             objects.append(fitting.Nnls)
 
-    # This is a constructor for the dynamic GCMS class
-    newobj = filetypes.GcmsMeta('Gcms', tuple(objects), {})
-    instance = newobj(fname, refs)
-    instance._reconstruct = reconstruct
-    if refs:
-        instance._ref_file = refs
-    return instance
+    return filetypes.GcmsMeta('Gcms', tuple(objects), {})
@@ -0,0 +1,293 @@
+'''Helpers for the HDF5 result files of the batch scripts.
+
+The results are buffered as arrays, and written to the PyTables tables as
+structured arrays, with one ``append`` call for many rows. This is much faster
+than appending one ``row`` at a time, and the chunks of the table are not
+rewritten for every data file.
+
+The fits of every data file can also be saved in a group under '/fits', and
+read back as a ``StoredFit``, which can be integrated again without the data
+file.
+
+Rows and groups that are replaced in incremental runs are removed in place.
+HDF5 does not reuse their space, so ``compact`` rewrites the file when
+requested.
+'''
+import os
+
+import numpy as np
+import tables as pyt
+
+from fitting import Nnls
+
+# Complib choices for the command line. 'none' turns off compression.
+COMPLIBS = ['blosc', 'zlib', 'lzo', 'bzip2', 'none']
+
+def filters(complib='blosc', complevel=5):
+    '''Return the PyTables compression filters for the result tables.'''
+    if complib == 'none' or complevel == 0:
+        return pyt.Filters(complevel=0)
+    return pyt.Filters(complevel=complevel, complib=complib, shuffle=True)
+
+
+def string_width(names, minimum=16):
+    '''The width of a string column for these names.
+
+    The width is rounded up to a multiple of 8, with some room for longer
+    names that are added in later incremental runs.
+    '''
+    longest = max([len(n) for n in names] + [minimum,])
+    return 8*( (longest + 8)//8 )
+
+
+def index_columns(table, names):
+    '''Make PyTables indexes for these columns, if they don't have one.
+
+    The indexes are updated automatically when rows are added, and they make
+    queries like ``getWhereList('fname == name')`` fast for large tables.
+    '''
+    for name in names:
+        col = getattr(table.cols, name)
+        if col.index is None:
+            col.createIndex()
+
+
+def remove_rows(table, column, values):
+    '''Remove all of the rows where a column has one of these values.
+
+    The rows of one data file are next to each other, so they are removed as
+    contiguous blocks, starting from the end so that the remaining row
+    numbers stay valid. The indexes of the table are only rebuilt once, at
+    the end.
+    '''
+    coords = [table.getWhereList('{} == value'.format(column),
+            condvars={'value': value}) for value in values]
+    coords = np.unique( np.concatenate([np.zeros(0, dtype=int)] + coords) )
+    if coords.size == 0:
+        return
+
+    breaks = np.nonzero( np.diff(coords) != 1 )[0] + 1
+    starts = np.append(coords[0], coords[breaks])
+    stops = np.append(coords[breaks - 1], coords[-1]) + 1
+
+    autoindex = table.autoIndex
+    table.autoIndex = False
+    for start, stop in zip(starts[::-1], stops[::-1]):
+        table.removeRows(start, stop)
+    table.autoIndex = autoindex
+    if autoindex:
+        table.reIndexDirty()
+
+
+def compact(fname):
+    '''Rewrite an HDF file to free the space of removed rows and nodes.
+
+    HDF5 does not reuse this space, so a file that is updated in place keeps
+    growing. All of the nodes are copied to a new file, with their filters
+    and indexes, and the new file replaces the old one. The file must be
+    closed.
+    '''
+    tmp = fname + 'temp'
+    pyt.copyFile(fname, tmp, overwrite=True, propindexes=True)
+    os.remove(fname)
+    os.rename(tmp, fname)
+
+
+def results_build(h5f, cal_cpds, names, bkg, bkg_time):
+    '''Make the integral and concentration tables of a data HDF file.
+
+    Arguments
+    ---------
+    * h5f: PyTables File - The open data file.
+    * cal_cpds: list - The names of the calibrated compounds.
+    * names: list - The data file names, which set the width of the fname
+      columns.
+    * bkg: bool - The background setting of the fits.
+    * bkg_time: The background time setting of the fits.
+    '''
+    # The string columns are only as wide as needed
+    fname_len = string_width(names)
+    cpd_len = string_width(cal_cpds)
+
+    col_dict = {cal_cpd: pyt.Float64Col() for cal_cpd in cal_cpds}
+    col_dict['fname'] = pyt.StringCol(fname_len, pos=0)
+
+    col_dict2 = col_dict.copy()
+    for cal_cpd in cal_cpds:
+        col_dict2[ cal_cpd+'_per' ] = pyt.Float64Col()
+    col_dict2['cpd_name'] = pyt.StringCol(cpd_len, pos=1)
+
+    int_table = h5f.createTable('/', 'int_data', col_dict2, 
+            "Raw Integration Data", 
+            expectedrows=max(1, len(names)*len(cal_cpds)))
+    int_table.attrs.bkg = bkg
+    int_table.attrs.bkg_time = bkg_time
+    index_columns(int_table, ['fname', 'cpd_name'])
+
+    conc_table = h5f.createTable('/', 'conc_data', col_dict, 
+            "Concentration Data", expectedrows=max(1, len(names)))
+    index_columns(conc_table, ['fname'])
+
+
+class ResultWriter(object):
+    '''Buffer the results of data files, and write them in bulk.
+
+    Only the arrays of every file are kept until ``flush``, which builds the
+    rows of all of the buffered files with one array operation per column.
+    The 'int_data', 'conc_data', and (if it exists) 'file_info' tables are
+    written in that order, so that a file is only marked as processed when
+    all of its results are saved.
+
+    Arguments
+    ---------
+    * h5f: PyTables File - The open data file.
+    * cal_cpds: list - The names of the calibrated compounds.
+    * buffer_rows: int - Flush once this many integral rows are buffered.
+    '''
+    def __init__(self, h5f, cal_cpds, buffer_rows=10000):
+        root = h5f.root
+        self.cal_cpds = list(cal_cpds)
+        self.buffer_rows = buffer_rows
+        self.int_table = root.int_data
+        self.conc_table = root.conc_data
+        self.file_table = None
+        if 'file_info' in root:
+            self.file_table = root.file_info
+        self._clear()
+
+    def _clear(self, ):
+        self._fnames = []
+        self._ints = []
+        self._sums = []
+        self._concs = []
+        self._stats = []
+
+    def write(self, fname, ints, concs, stats=None):
+        '''Buffer the results of one data file.
+
+        Arguments
+        ---------
+        * fname: string - The data file name.
+        * ints: array - The integrals of every calibrated compound window
+          (compounds x refs).
+        * concs: array - The concentration of every calibrated compound.
+        * stats: None or tuple - The (size, mtime) of the data file for the
+          'file_info' table.
+        '''
+        ncpd = len(self.cal_cpds)
+        self._fnames.append(fname)
+        self._ints.append( ints[:, :ncpd] )
+        # The fractions are relative to all of the references in a window
+        self._sums.append( ints.sum(axis=1) )
+        self._concs.append(concs)
+        if stats is not None:
+            self._stats.append( (fname,) + tuple(stats) )
+
+        if len(self._fnames)*ncpd >= self.buffer_rows:
+            self.flush()
+
+    def flush(self, ):
+        '''Write all of the buffered results.'''
+        if not self._fnames:
+            return
+        ncpd = len(self.cal_cpds)
+        names = [f[:-4] for f in self._fnames]
+
+        # (files*compounds) x compounds
+        ints = np.concatenate(self._ints)
+        per = ints/np.concatenate(self._sums)[:, np.newaxis]
+        int_rows = np.zeros(ints.shape[0], dtype=self.int_table.dtype)
+        int_rows['fname'] = np.repeat(names, ncpd)
+        int_rows['cpd_name'] = self.cal_cpds*len(names)
+        for n, cal_cpd in enumerate(self.cal_cpds):
+            int_rows[ cal_cpd ] = ints[:, n]
+            int_rows[ cal_cpd+'_per' ] = per[:, n]
+        self.int_table.append(int_rows)
+        self.int_table.flush()
+
+        # files x compounds
+        concs = np.array(self._concs).reshape(-1, ncpd)
+        conc_rows = np.zeros(len(names), dtype=self.conc_table.dtype)
+        conc_rows['fname'] = names
+        for n, cal_cpd in enumerate(self.cal_cpds):
+            conc_rows[ cal_cpd ] = concs[:, n]
+        self.conc_table.append(conc_rows)
+        self.conc_table.flush()
+
+        if self.file_table is not None and self._stats:
+            info_rows = np.array(self._stats, dtype=self.file_table.dtype)
+            self.file_table.append(info_rows)
+            self.file_table.flush()
+
+        self._clear()
+
+
+def fits_save(h5f, fit, filters=None, chunk_scans=1024, **attrs):
+    '''Save the fit results of a data file in a group under '/fits'.
+
+    The group is named after the data file, without the extension, and any
+    older group of the same name is replaced. The times, tic, fits and
+    reference spectra are saved as chunked, compressed arrays, and the
+    reference names and data file name as attributes.
+
+    Arguments
+    ---------
+    * h5f: PyTables File - The open HDF file.
+    * fit: GCMS object - A fit data file. The intensity data is not needed.
+    * filters: None or PyTables Filters - The compression of the arrays. The
+      filters of the file are used by default.
+    * chunk_scans: int - The number of scans in a chunk of the arrays.
+    * attrs: Any other attributes to save, e.g. the fit settings.
+    '''
+    fname = os.path.basename(fit.filename)
+    if '/fits' not in h5f:
+        h5f.createGroup('/', 'fits', 'Saved Fits')
+    name = fname[:-4]
+    if name in h5f.root.fits:
+        h5f.removeNode(h5f.root.fits, name, recursive=True)
+    group = h5f.createGroup(h5f.root.fits, name, 'Fit of '+fname)
+
+    for key in ('times', 'tic', 'fits', 'ref_array'):
+        arr = np.asarray( getattr(fit, key) )
+        chunks = (min(chunk_scans, max(arr.shape[0], 1)),) + arr.shape[1:]
+        carr = h5f.createCArray(group, key, pyt.Atom.from_dtype(arr.dtype),
+                arr.shape, filters=filters, chunkshape=chunks)
+        carr[:] = arr
+
+    group._v_attrs.fname = fname
+    group._v_attrs.ref_files = list(fit.ref_files)
+    for key, val in attrs.items():
+        setattr(group._v_attrs, key, val)
+
+
+def fits_remove(h5f, names):
+    '''Remove the saved fits of these data files, if there are any.'''
+    if '/fits' not in h5f:
+        return
+    for fname in names:
+        if fname[:-4] in h5f.root.fits:
+            h5f.removeNode(h5f.root.fits, fname[:-4], recursive=True)
+
+
+class StoredFit(Nnls):
+    '''The saved fit results of one data file.
+
+    This has the attributes of a fit GCMS object that are used by the
+    integration methods (``times``, ``tic``, ``fits``, ``ref_array``, and
+    ``ref_files``), so a fit can be integrated again without the data file.
+    The other saved attributes are in the ``fit_attrs`` dictionary.
+
+    Arguments
+    ---------
+    * group: PyTables Group - A group that was made by ``fits_save``.
+    '''
+    def __init__(self, group):
+        attrs = group._v_attrs
+        self.filename = attrs.fname
+        self.ref_files = list(attrs.ref_files)
+        self.times = group.times[:]
+        self.tic = group.tic[:]
+        self.fits = group.fits[:]
+        self.ref_array = group.ref_array[:]
+        self.fit_attrs = dict( (key, getattr(attrs, key)) 
+                for key in attrs._v_attrnamesuser )
@@ -0,0 +1,381 @@
+'''Reference libraries that are shared by many data files.
+
+A ``RefLibrary`` holds every reference spectrum of a reference file as a
+sparse matrix on the full nominal mass axis. Reference files are parsed in
+bulk with whole-file regular expressions, and the compiled library is kept
+in the disk cache (see ``cache``) until the reference file changes. The
+spectra are projected onto the mass axis of each data file with ``project``.
+
+For multiprocess runs, ``share`` copies the spectra into shared memory. The
+shared library is passed to the workers through the ``Pool`` initializer, so
+that every process reads the same read-only copy of the spectra.
+'''
+import io
+import re
+import json
+from multiprocessing.sharedctypes import RawArray
+
+import numpy as np
+import scipy.sparse as sparse
+
+import cache
+
+# Version of the compiled library arrays. This is part of the cache key, so
+# old cache files are not reused after a format change.
+_FORMAT = 2
+
+# The library that was set in this process by ``pool_init``
+_LIBRARY = None
+
+# The patterns start with a literal newline, which is much faster to search
+# for than a multiline "^". The text is parsed with a leading newline.
+_COMMENT = re.compile(r'\n#[^\n]*')
+# NAME lines split the text into entries
+_NAME = re.compile(r'\n[ \t]*NAME[ \t]*:([^:\n]*)[^\n]*')
+# "KEY:value" lines. Like the original line parser, only the text up to a
+# second colon is kept as the value.
+_META = re.compile(r'\n([^:\n]*):([^:\n]*)')
+# The NUM PEAKS line, and the block of peak lines after it. The block ends at
+# a blank line or at the next "KEY:value" line.
+_PEAKS = re.compile(r'\n[^:\n]*NUM PEAKS?[ \t]*:[^\n]*'
+        r'((?:\n[ \t]*[^\s:][^:\n]*(?=\n|$))*)')
+# Peaks are "mass intensity ..." lines in txt files
+_TXT_PEAK = re.compile(r'^[ \t]*(\S+)[ \t]+(\S+)[^\n]*', re.M)
+
+# The CSR arrays of a shared library: (name, ctypes code, dtype)
+_SHARED = (('data', 'd', float), ('indices', 'i', np.intc), 
+        ('indptr', 'i', np.intc))
+
+class RefLibrary(object):
+    '''A parsed reference file.
+
+    Attributes
+    ----------
+    * source: string - The name of the reference file.
+    * names: list - The reference names, in file order.
+    * meta: dict - The metadata of each reference, keyed by name.
+    * spectra: CSR matrix - The raw reference intensities (references x
+      nominal masses). Column n is the intensity at mass n.
+    '''
+    def __init__(self, source, names, meta, spectra):
+        self.source = source
+        self.names = list(names)
+        self.meta = meta
+        self.spectra = spectra
+        self._raw = None
+
+    @classmethod
+    def load(cls, fname, encoding='ascii', use_cache=True):
+        '''Load a reference library.
+
+        Arguments
+        ---------
+        * fname: string - The name of a ".txt" or ".MSL" reference file, or
+          of a compiled library that was written with ``save``.
+        * encoding: string - The text encoding of the reference file.
+        * use_cache: bool - Read and write the compiled library from the disk
+          cache.
+        '''
+        if fname[-4:].lower() == '.npz':
+            with np.load(fname) as data:
+                return cls._from_arrays(fname, data)
+
+        key = cache.cache_key(cache.file_hash(fname), encoding, _FORMAT)
+        if use_cache:
+            data = cache.load_arrays('reflib', key)
+            if data is not None:
+                return cls._from_arrays(fname, data)
+
+        lib = cls.parse(fname, encoding)
+        if use_cache:
+            cache.save_arrays('reflib', key, **lib._arrays())
+        return lib
+
+    @classmethod
+    def parse(cls, fname, encoding='ascii'):
+        '''Parse a ".txt" or ".MSL" reference file.'''
+        filetype = fname[-3:].lower()
+        if filetype == 'txt':
+            numbers = _txt_numbers
+        elif filetype == 'msl':
+            numbers = _msl_numbers
+        else:
+            raise ValueError("Unknown reference file type: {}".format(fname))
+
+        with io.open(fname, encoding=encoding) as f:
+            text = f.read()
+
+        names, meta, spectra = _parse_text(text, numbers)
+        return cls(fname, names, meta, spectra)
+
+    def save(self, fname):
+        '''Save the compiled library to an ".npz" file for ``load``.'''
+        np.savez(fname, **self._arrays())
+
+    def project(self, masses):
+        '''Return the normalized spectra on the mass axis of a data file.
+
+        Only the masses that are strictly inside of the data mass range are
+        kept, and every spectrum is divided by its maximum.
+        '''
+        lo, hi = masses.min(), masses.max()
+        spec = np.zeros((len(self.names), masses.size), dtype=float)
+        top = min(hi, self.spectra.shape[1])
+        if top > lo + 1:
+            spec[:, 1:top-lo] = self.spectra[:, lo+1:top].toarray()
+        return spec/spec.max(axis=1)[:, np.newaxis]
+
+    def share(self, ):
+        '''Return a copy of this library with the spectra in shared memory.
+
+        The shared library can be sent to worker processes as an argument of
+        the ``Pool`` initializer (see ``pool_init``). The workers see a
+        read-only view of the same memory.
+        '''
+        lib = RefLibrary(self.source, self.names, self.meta, None)
+        lib._shape = self.spectra.shape
+        lib._raw = {}
+        for name, code, dtype in _SHARED:
+            arr = getattr(self.spectra, name)
+            lib._raw[name] = RawArray(code, arr.size)
+            np.frombuffer(lib._raw[name], dtype=dtype)[:] = arr
+        lib.spectra = lib._view()
+        return lib
+
+    def _view(self, ):
+        '''Read-only CSR matrix of the shared memory arrays.'''
+        arrays = []
+        for name, code, dtype in _SHARED:
+            arr = np.frombuffer(self._raw[name], dtype=dtype)
+            arr.flags.writeable = False
+            arrays.append(arr)
+        return sparse.csr_matrix(tuple(arrays), shape=self._shape,
+                copy=False)
+
+    def _arrays(self, ):
+        '''The compiled library as a dictionary of arrays.'''
+        return {'names': np.array(self.names),
+                'meta': np.array(json.dumps(self.meta)),
+                'data': self.spectra.data,
+                'indices': self.spectra.indices,
+                'indptr': self.spectra.indptr,
+                'shape': np.array(self.spectra.shape)}
+
+    @classmethod
+    def _from_arrays(cls, source, data):
+        spectra = sparse.csr_matrix((data['data'], data['indices'],
+                data['indptr']), shape=tuple(data['shape']))
+        return cls(source, data['names'].tolist(),
+                json.loads(data['meta'].item()), spectra)
+
+    def __getstate__(self, ):
+        # Shared memory is sent as the RawArrays themselves, which only works
+        # when a worker process is started
+        state = self.__dict__.copy()
+        if self._raw is not None:
+            state['spectra'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self._raw is not None:
+            self.spectra = self._view()
+
+
+class RefIndex(object):
+    '''An index of the strongest ions of a set of reference spectra.
+
+    The index shortlists the references that can be in a scan before it is
+    fit. A reference is a candidate for a scan if its base peak and at least
+    ``min_hits`` of its ``top_n`` strongest ions are present in the scan. An
+    ion is present if it is above ``rel`` times the largest intensity of the
+    scan. The candidates are combined over a window of ``window`` scans, so
+    the edges of a peak are fit with the same references as its apex.
+
+    The candidates are looked up in inverted lists from the ions of a scan
+    to the references, so the work depends on the number of present ions and
+    listed references, not on the size of the library.
+
+    Attributes
+    ----------
+    * base_peak: int array - The mass column of the base peak of each
+      reference.
+    * top_ions: int array - The mass columns of the ``top_n`` strongest ions
+      of each reference (references x top_n).
+    * base_lists, top_lists: CSR matrix - Inverted lists (masses x
+      references). Row n holds the references with mass column n as their
+      base peak or as one of their top ions.
+    '''
+    def __init__(self, ref_array, top_n=5, min_hits=3, rel=0.01, window=5):
+        '''
+        Arguments
+        ---------
+        * ref_array: array - The normalized reference spectra (references x
+          masses), e.g. the ``ref_array`` of a GCMS file object.
+        * top_n: int - The number of strongest ions per reference.
+        * min_hits: int - The number of top ions that must be present.
+        * rel: float - The presence threshold relative to the scan maximum.
+        * window: int - The number of scans that candidates are combined
+          over.
+        '''
+        self.top_n = top_n
+        self.min_hits = min_hits
+        self.rel = rel
+        self.window = window
+
+        nref, nmass = ref_array.shape
+        top_n = min(top_n, nmass)
+        order = np.argsort(-ref_array, axis=1, kind='mergesort')
+        self.base_peak = order[:, 0]
+        self.top_ions = order[:, :top_n]
+
+        # Ions with zero intensity are not counted as top ions
+        strong = ref_array[np.arange(nref)[:, np.newaxis], self.top_ions] > 0
+        self._need = np.minimum(min_hits, strong.sum(axis=1))
+
+        refs = np.repeat(np.arange(nref), top_n)
+        self.top_lists = sparse.csr_matrix((strong.ravel().astype(float), 
+                (self.top_ions.ravel(), refs)), shape=(nmass, nref))
+        self.top_lists.eliminate_zeros()
+        self.base_lists = sparse.csr_matrix((np.ones(nref), 
+                (self.base_peak, np.arange(nref))), shape=(nmass, nref))
+
+    def settings(self, ):
+        '''The index settings, e.g. for cache keys.'''
+        return [self.top_n, self.min_hits, self.rel, self.window]
+
+    def candidates(self, block):
+        '''Return a boolean (scans x references) array of candidates.
+
+        The references with a present base peak are shortlisted from
+        ``base_lists``, and only their top ion hits from ``top_lists`` are
+        checked. The window of scans is not applied here (see ``masks``).
+        '''
+        peak = block.max(axis=1)[:, np.newaxis]
+        present = sparse.csr_matrix( (block > self.rel*peak) & (block > 0),
+                dtype=float )
+
+        short = present.dot(self.base_lists).tocoo()
+        hits = present.dot(self.top_lists).tocsr()
+        counts = np.asarray( hits[short.row, short.col] ).ravel()
+        keep = counts >= self._need[short.col]
+
+        cands = np.zeros((block.shape[0], self.base_peak.size), dtype=bool)
+        cands[short.row[keep], short.col[keep]] = True
+        return cands
+
+    def masks(self, gcms):
+        '''Return the candidate masks for all of the scans of a file.
+
+        The scans are read in chunks of the file's ``chunk_scans``.
+        '''
+        nscans = gcms.times.size
+        masks = [self.candidates( gcms.intensity_rows(first, 
+                first + gcms.chunk_scans) ) 
+                for first in range(0, nscans, gcms.chunk_scans)]
+        masks = np.concatenate(masks) if masks else \
+                np.zeros((0, self.base_peak.size), dtype=bool)
+
+        # Combine the candidates over the window of scans
+        grown = masks.copy()
+        for shift in range(1, self.window//2 + 1):
+            grown[shift:] |= masks[:-shift]
+            grown[:-shift] |= masks[shift:]
+        return grown
+
+
+def pool_init(library):
+    '''``Pool`` initializer that sets the library of a worker process.
+
+    Example
+    -------
+    >>> lib = RefLibrary.load('ref_specs.txt').share()
+    >>> pool = Pool(4, initializer=pool_init, initargs=(lib,))
+    '''
+    global _LIBRARY
+    _LIBRARY = library
+
+
+def get_library():
+    '''Return the library that was set by ``pool_init``, or None.'''
+    return _LIBRARY
+
+
+def _parse_text(text, numbers):
+    '''Parse the text of a reference file.
+
+    The text is split into entries at the NAME lines, and the metadata lines
+    and the block of peaks of every entry are found with regular expressions.
+    The peaks of all entries are converted to numbers at once. Entries
+    without any peaks are skipped. If a mass is repeated in one spectrum, the
+    last intensity is kept.
+
+    Arguments
+    ---------
+    * text: string - The reference file text.
+    * numbers: function - Converts a block of peak lines to a string of
+      "mass intensity" numbers, and returns it with the number of peaks.
+
+    Returns
+    -------
+    * names: list - The names of the entries with peaks.
+    * meta: dict - The metadata of each entry.
+    * spectra: CSR matrix - The intensities (entries x nominal masses).
+    '''
+    text = _COMMENT.sub('', '\n' + text)
+    parts = _NAME.split(text)
+
+    names = []
+    meta = {}
+    counts = []
+    blocks = []
+    for name, entry in zip(parts[1::2], parts[2::2]):
+        peaks = _PEAKS.search(entry)
+        if peaks is None:
+            continue
+        name = name.strip()
+        block, count = numbers( peaks.group(1) )
+        names.append(name)
+        counts.append(count)
+        blocks.append(block)
+
+        header = entry[:peaks.start()] + entry[peaks.end():]
+        meta[name] = dict( (k.strip(), v.strip()) for k, v in 
+                _META.findall(header) )
+
+    values = np.fromstring(' '.join(blocks), sep=' ')
+    if values.size != 2*sum(counts):
+        raise ValueError("Could not read all of the reference peaks.")
+    values = values.reshape(-1, 2)
+
+    rows = np.repeat(np.arange(len(names)), counts)
+    masses = np.round(values[:,0]).astype(int)
+    intensities = values[:,1]
+    keep = masses >= 0
+    rows, masses, intensities = rows[keep], masses[keep], intensities[keep]
+
+    # Sort the peaks by entry and mass. The sort is stable, so the last
+    # peak of a repeated mass is at the end of its run.
+    order = np.lexsort((masses, rows))
+    rows, masses, intensities = rows[order], masses[order], \
+            intensities[order]
+    last = np.ones(rows.size, dtype=bool)
+    last[:-1] = (rows[1:] != rows[:-1]) | (masses[1:] != masses[:-1])
+    rows, masses, intensities = rows[last], masses[last], intensities[last]
+
+    indptr = np.append(0, np.cumsum( np.bincount(rows,
+            minlength=len(names)) ))
+    ncols = masses.max() + 1 if masses.size else 0
+    spectra = sparse.csr_matrix((intensities, masses.astype(np.intc),
+            indptr.astype(np.intc)), shape=(len(names), ncols))
+    return names, meta, spectra
+
+
+def _txt_numbers(block):
+    '''The masses and intensities of a block of txt peak lines.'''
+    return _TXT_PEAK.subn(r'\1 \2', block)
+
+
+def _msl_numbers(block):
+    '''The masses and intensities of a block of "(mass intensity)" pairs.'''
+    return block.replace('(', ' ').replace(')', ' '), block.count('(')
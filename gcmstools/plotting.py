@@ -0,0 +1,96 @@
+'''Deferred plots for the batch scripts.
+
+The scripts don't draw while they process the data files. They only collect
+plot jobs, which hold the small arrays of a plot (e.g. the simulated trace of
+one compound in its integration window). The jobs are rendered after all of
+the results are written, in parallel with ``render``. matplotlib is only
+imported when a plot is drawn.
+
+A job is a tuple of a plot function from this module and its arguments.
+'''
+import sys
+import fnmatch
+from multiprocessing import Pool
+
+
+def wanted(name, patterns):
+    '''Check if a file or compound name should be plotted.
+
+    Arguments
+    ---------
+    * name: string - The name of a data file or compound.
+    * patterns: None or list - No plots if None, all plots if empty, or only
+      the names that match one of these shell-style patterns.
+    '''
+    if patterns is None:
+        return False
+    if not patterns:
+        return True
+    return any(fnmatch.fnmatch(name, pat) for pat in patterns)
+
+
+def fit_plot(outname, traces, tic=None, title=None, xlim=None, tic_lw=1.5,
+        dpi=200):
+    '''Plot simulated fit traces over the TIC.
+
+    Arguments
+    ---------
+    * outname: string - The name of the image file.
+    * traces: list - (times, intensities) pairs of the simulated traces.
+    * tic: None or tuple - The (times, tic) of the plotted window.
+    * title: None or string - The plot title.
+    * xlim: None or tuple - The limits of the time axis.
+    * tic_lw: float - The line width of the TIC.
+    * dpi: int - The resolution of the image.
+    '''
+    plt = _pyplot()
+    plt.figure()
+    for times, trace in traces:
+        plt.plot(times, trace)
+    if tic is not None:
+        plt.plot(tic[0], tic[1], 'k', lw=tic_lw)
+    if title:
+        plt.title(title)
+    if xlim:
+        plt.xlim(*xlim)
+    plt.savefig(outname, dpi=dpi)
+    plt.close()
+
+
+def cal_curve_plot(outname, conc, ints, slope, intercept, r, dpi=200):
+    '''Plot a calibration curve with its regression line.'''
+    plt = _pyplot()
+    plt.figure()
+    plt.plot(conc, slope*conc + intercept, 'k-')
+    plt.plot(conc, ints, 'o', ms=8)
+    text_string = 'Slope: {:.2f}\nIntercept: {:.2f}\nR^2: {:.5f}'
+    plt.text(0.5, ints.max()*0.8, text_string.format(slope, intercept, r**2))
+    plt.savefig(outname, dpi=dpi)
+    plt.close()
+
+
+def render(jobs, nproc=1):
+    '''Draw a list of plot jobs, using nproc processes.'''
+    if nproc > 1 and len(jobs) > 1:
+        pool = Pool(nproc)
+        pool.map(_render, jobs, chunksize=max(1, len(jobs)//(4*nproc)))
+        pool.close()
+        pool.join()
+    else:
+        for job in jobs:
+            _render(job)
+
+
+def _render(job):
+    func, func_args = job
+    func(*func_args)
+
+
+def _pyplot():
+    # Plots are only saved to files, so use the non-interactive backend if
+    # pyplot hasn't been set up yet
+    if 'matplotlib.pyplot' not in sys.modules:
+        import matplotlib
+        matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    return plt
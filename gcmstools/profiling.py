@@ -0,0 +1,201 @@
+'''Phase timings and counters for the processing pipeline.
+
+The stages of the pipeline report into one registry per process. Every
+phase (e.g. 'load', 'fit', 'write') adds its wall time and number of calls,
+and counters such as 'scans' or 'bytes_read' are summed.
+
+Profiling is off by default, and then ``phase`` returns a shared context
+manager that does nothing. Turn it on with ``enable``, or by setting the
+``GCMSTOOLS_PROFILE`` environment variable to any value other than '' or
+'0'. ``summary`` returns the results as a JSON serializable dictionary.
+
+Example
+-------
+>>> import profiling
+>>> profiling.enable()
+>>> with profiling.phase('fit'):
+...     aia.nnls()
+>>> profiling.summary(fname=aia.filename)
+'''
+import os
+import sys
+import json
+import time
+import threading
+import functools
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows
+    resource = None
+
+_ENABLED = os.environ.get('GCMSTOOLS_PROFILE', '') not in ('', '0')
+_LOCK = threading.Lock()
+# Phase name -> [seconds, calls]
+_PHASES = {}
+# Counter name -> value
+_COUNTS = {}
+_START = time.time()
+
+def enable(on=True):
+    '''Turn profiling on or off.
+
+    The environment variable is also set, so that worker processes that are
+    started later are profiled too.
+    '''
+    global _ENABLED
+    _ENABLED = bool(on)
+    os.environ['GCMSTOOLS_PROFILE'] = '1' if on else '0'
+
+
+def enabled():
+    return _ENABLED
+
+
+def reset():
+    '''Clear all of the phases and counters, and restart the wall clock.'''
+    global _START
+    with _LOCK:
+        _PHASES.clear()
+        _COUNTS.clear()
+        _START = time.time()
+
+
+def phase(name):
+    '''Return a context manager that times a phase.'''
+    if not _ENABLED:
+        return _NULL
+    return _Phase(name)
+
+
+def timed(name):
+    '''Decorator that times every call of a function as a phase.'''
+    def decorate(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _ENABLED:
+                return func(*args, **kwargs)
+            with _Phase(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+def count(name, value=1):
+    '''Add to a counter.'''
+    if not _ENABLED:
+        return
+    with _LOCK:
+        _COUNTS[name] = _COUNTS.get(name, 0) + value
+
+
+def summary(since=None, **extra):
+    '''Return the phases and counters of this process as a dictionary.
+
+    The wall time is measured from the last ``reset`` (or the import of this
+    module). If ``since`` is an earlier summary, only the time and counts
+    after it are returned, e.g. for one file in a long running process. The
+    peak memory is always the peak of the process. Any other keyword
+    arguments are added to the dictionary.
+    '''
+    with _LOCK:
+        out = {'wall_time': time.time() - _START,
+            'phases': dict( (k, {'seconds': v[0], 'calls': v[1]})
+                for k, v in _PHASES.items() ),
+            'counters': dict(_COUNTS),
+            'peak_memory': peak_memory(),
+            'pid': os.getpid()}
+
+    if since is not None:
+        out['wall_time'] -= since['wall_time']
+        for name, p in since['phases'].items():
+            p_out = out['phases'][name]
+            p_out['seconds'] -= p['seconds']
+            p_out['calls'] -= p['calls']
+            if p_out['calls'] == 0:
+                del out['phases'][name]
+        for name, val in since['counters'].items():
+            out['counters'][name] -= val
+            if out['counters'][name] == 0:
+                del out['counters'][name]
+
+    out.update(extra)
+    out['scans_per_sec'] = _rate(out)
+    return out
+
+
+def combine(summaries, **extra):
+    '''Combine the summaries of many files into one batch summary.
+
+    The phase times and counters are summed, and the peak memory is the
+    largest of all of the summaries. Pass the wall time of the batch as the
+    ``wall_time`` keyword to get the scan rate of the batch.
+    '''
+    out = {'phases': {}, 'counters': {}, 'peak_memory': 0, 'files': 0}
+    for s in summaries:
+        out['files'] += 1
+        for name, p in s['phases'].items():
+            total = out['phases'].setdefault(name, {'seconds': 0.,
+                    'calls': 0})
+            total['seconds'] += p['seconds']
+            total['calls'] += p['calls']
+        for name, val in s['counters'].items():
+            out['counters'][name] = out['counters'].get(name, 0) + val
+        out['peak_memory'] = max(out['peak_memory'], s['peak_memory'] or 0)
+    out.update(extra)
+    out['scans_per_sec'] = _rate(out)
+    return out
+
+
+def write(fname, record):
+    '''Append a summary to a file of JSON records, one per line.'''
+    with open(fname, 'a') as f:
+        f.write( json.dumps(record, sort_keys=True) + '\n' )
+
+
+def peak_memory():
+    '''The peak resident memory of this process in bytes, or None.'''
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, and macOS reports bytes
+    if sys.platform != 'darwin':
+        peak *= 1024
+    return peak
+
+
+def _rate(out):
+    # Scans loaded per second of wall time
+    wall = out.get('wall_time', 0.)
+    if wall > 0:
+        return out['counters'].get('scans', 0)/wall
+    return None
+
+
+class _Phase(object):
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self, ):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc):
+        elapsed = time.time() - self.start
+        with _LOCK:
+            total = _PHASES.setdefault(self.name, [0., 0])
+            total[0] += elapsed
+            total[1] += 1
+        return False
+
+
+class _NullPhase(object):
+    '''The phase context manager when profiling is off.'''
+    def __enter__(self, ):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+_NULL = _NullPhase()
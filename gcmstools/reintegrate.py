@@ -0,0 +1,102 @@
+'''Recompute the sample results from the fits that were saved by data.py.
+
+Run data.py once with '--save_fits'. After the integration windows or
+calibrations change, this script rebuilds the 'int_data' and 'conc_data'
+tables of the data HDF file from the saved fits alone. No data files are
+read, and nothing is fit again. The data files without saved fits are removed
+from the 'file_info' table, so the next 'data.py --incremental' run processes
+them again.
+'''
+import tables as pyt
+
+#import chem.gcms as gcms
+import gcms
+import cache
+import profiling
+import plotting
+import h5tables
+
+# Get the command line arguments
+args = gcms.get_args()
+batch_mark = profiling.summary()
+
+h5f = pyt.openFile(args.data_name, 'a')
+if 'fits' not in h5f.root:
+    h5f.close()
+    raise ValueError("There are no saved fits in {}. Run data.py with "
+            "'--save_fits' first.".format(args.data_name))
+
+# The saved fits were made with the background settings of the data file
+args.nobkg = h5f.root.int_data.attrs.bkg
+args.bkg_time = h5f.root.int_data.attrs.bkg_time
+
+# Open the calibration data file
+cal = pyt.openFile(args.cal_name)
+cal_table = cal.root.cals
+
+gcms.table_check(cal_table, args)
+
+# The calibration table is read once, as arrays
+cal_rows = cal_table[:]
+calib = gcms.Calibration(cal_rows)
+cal_cpds = calib.names
+
+if args.cal_type == 'internal':
+    std_cons = gcms.std_cons_read('data.csv')
+
+groups = sorted(h5f.root.fits._v_groups.values(), key=lambda g: g._v_name)
+files = [g._v_attrs.fname for g in groups]
+print 'Files to reintegrate:', len(files)
+
+# The calibrated compounds may have changed, so the tables are made again
+with profiling.phase('write'):
+    h5f.removeNode('/', 'int_data')
+    h5f.removeNode('/', 'conc_data')
+    h5tables.results_build(h5f, cal_cpds, files, args.nobkg, args.bkg_time)
+    # The results are only marked as up to date if all of the fits used the
+    # current reference file, so that 'data.py --incremental' refits them
+    # otherwise
+    ref_hash = cache.file_hash(args.ref_name)
+    if all(getattr(g._v_attrs, 'ref_hash', None) == ref_hash for g in groups):
+        h5f.root.int_data.attrs.results_key = gcms.results_key(args, 
+                cal_rows)
+
+    file_table = h5f.root.file_info
+    saved = set(files)
+    missing = [row['fname'] for row in file_table if row['fname'] not in saved]
+    if missing:
+        print \
+'''Warning: {} processed data files have no saved fits. Their results are
+removed, and they will be processed again by 'data.py --incremental'.
+'''.format(len(missing))
+        h5tables.remove_rows(file_table, 'fname', missing)
+
+writer = h5tables.ResultWriter(h5f, cal_cpds)
+plot_jobs = []
+for group in groups:
+    fit = h5tables.StoredFit(group)
+    std_con = None
+    if args.cal_type == 'internal':
+        std_con = std_cons[fit.filename]
+    ints, concs, plots = gcms.quantitate(fit, fit.filename, calib, args,
+            std_con)
+    with profiling.phase('write'):
+        writer.write(fit.filename, ints, concs)
+    plot_jobs.extend(plots)
+
+with profiling.phase('write'):
+    writer.flush()
+
+cal.close()
+h5f.close()
+
+if args.compact:
+    with profiling.phase('write'):
+        h5tables.compact(args.data_name)
+
+# All of the results are saved, so draw the plots
+with profiling.phase('plot'):
+    plotting.render(plot_jobs, args.nproc)
+
+if profiling.enabled():
+    gcms.profile_write(args, batch_mark, [])